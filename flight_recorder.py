@@ -0,0 +1,301 @@
+"""Flight-data recorder: a compact binary log of a dive for post-dive analysis.
+
+    recorder = FlightRecorder("dives/")
+    recorder.start()
+    recorder.record(KIND_COMMAND, code=1, channel=client_id, seq=sequence, value=80)
+
+Every record is the same 24 bytes (RECORD): wall-clock timestamp, kind, a
+kind-specific code/channel/sequence and two float values (see KINDS for what
+each kind puts where). record() only packs into a preallocated in-RAM ring
+buffer; a background thread drains the ring into segment files, so a slow SD
+card never blocks the control loop and memory stays bounded. If the writer
+falls a whole ring behind, the oldest unwritten records are overwritten and
+counted as `dropped`.
+
+Segments are flight-<start time>-<n>.rec: a 24-byte HEADER then records
+back to back, rotated by size or age. FlightLog memory-maps a segment as a
+NumPy structured array, so hours of logs can be indexed and sliced without
+parsing them; run this module to summarize or replay a directory:
+
+    python flight_recorder.py summary dives/
+    python flight_recorder.py replay dives/ --kind command --speed 4
+"""
+import argparse
+import atexit
+import glob
+import mmap
+import os
+import struct
+import threading
+import time
+
+import numpy as np
+
+# timestamp (f64, unix seconds), kind (u8), code (u8), channel (u16),
+# sequence (u32), value (f32), extra (f32)
+RECORD = struct.Struct("<dBBHIff")
+RECORD_DTYPE = np.dtype([
+    ("timestamp", "<f8"), ("kind", "u1"), ("code", "u1"), ("channel", "<u2"),
+    ("seq", "<u4"), ("value", "<f4"), ("extra", "<f4"),
+])
+# magic, format version, record size, segment start time; same size as a record
+HEADER = struct.Struct("<8sHH4xd")
+MAGIC = b"ROVFDR\r\n"
+VERSION = 1
+
+# kind -> (name, what code / channel / seq / value / extra hold)
+KIND_MESSAGE = 1
+KIND_COMMAND = 2
+KIND_SETPOINT = 3
+KIND_GPIO_LEVEL = 4
+KIND_GPIO_DUTY = 5
+KIND_FRAME = 6
+KINDS = {
+    KIND_MESSAGE: ("message", "message type / client / - / size in bytes / -"),
+    KIND_COMMAND: ("command", "command / client / control sequence / power / lease ms"),
+    KIND_SETPOINT: ("setpoint", "command / - / - / power / 1 if a lease expired"),
+    KIND_GPIO_LEVEL: ("gpio_level", "- / pin / - / level / -"),
+    KIND_GPIO_DUTY: ("gpio_duty", "- / pin / - / duty cycle / -"),
+    KIND_FRAME: ("frame", "codec / quality level / sequence / capture-to-published s / bytes"),
+}
+KIND_IDS = {name: kind for kind, (name, _) in KINDS.items()}
+
+
+class FlightRecorder:
+    def __init__(self, directory, capacity=65536, segment_bytes=64 << 20,
+                 segment_seconds=600, flush_interval=0.2):
+        self.directory = directory
+        self.capacity = capacity
+        self.segment_bytes = segment_bytes
+        self.segment_seconds = segment_seconds
+        self.flush_interval = flush_interval
+        self.ring = bytearray(capacity * RECORD.size)
+        # Running totals; the ring index is total % capacity
+        self.head = 0
+        self.tail = 0
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.running = False
+        self.thread = None
+        self.segment = None
+        self.segment_path = None
+        self.segment_started = 0.0
+        self.segment_size = 0
+        self.counters = {
+            "recorded": 0,
+            "written": 0,
+            "dropped": 0,
+            "rejected": 0,
+            "segments": 0,
+            "write_errors": 0,
+        }
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="flight-recorder", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def record(self, kind, code=0, channel=0, seq=0, value=0.0, extra=0.0):
+        """Append one record; never blocks on I/O and never raises"""
+        with self.lock:
+            try:
+                RECORD.pack_into(self.ring, (self.head % self.capacity) * RECORD.size,
+                                 time.time(), kind, code, channel, seq & 0xFFFFFFFF,
+                                 value, extra)
+            except struct.error:
+                self.counters["rejected"] += 1
+                return
+            self.head += 1
+            self.counters["recorded"] += 1
+            if self.head - self.tail > self.capacity:
+                # Writer is a whole ring behind: the oldest record was just overwritten
+                self.tail += 1
+                self.counters["dropped"] += 1
+            backlog = self.head - self.tail
+        if backlog == self.capacity // 2:
+            self.wakeup.set()
+
+    def take(self):
+        """Copy out everything recorded since the last call"""
+        with self.lock:
+            count = self.head - self.tail
+            start = (self.tail % self.capacity) * RECORD.size
+            end = start + count * RECORD.size
+            if end <= len(self.ring):
+                data = bytes(self.ring[start:end])
+            else:
+                data = bytes(self.ring[start:]) + bytes(self.ring[:end - len(self.ring)])
+            self.tail = self.head
+        return data, count
+
+    def open_segment(self, now):
+        if self.segment is not None:
+            self.segment.close()
+        self.counters["segments"] += 1
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(now))
+        self.segment_path = os.path.join(
+            self.directory, f"flight-{stamp}-{self.counters['segments']:04d}.rec")
+        self.segment = open(self.segment_path, "wb")
+        self.segment.write(HEADER.pack(MAGIC, VERSION, RECORD.size, now))
+        self.segment_started = now
+        self.segment_size = HEADER.size
+
+    def write(self, data, count):
+        now = time.time()
+        try:
+            if (self.segment is None or self.segment_size >= self.segment_bytes
+                    or now - self.segment_started >= self.segment_seconds):
+                self.open_segment(now)
+            self.segment.write(data)
+            # Into the page cache, so a crash of this process loses nothing
+            self.segment.flush()
+            self.segment_size += len(data)
+            self.counters["written"] += count
+        except OSError:
+            self.counters["write_errors"] += 1
+
+    def run(self):
+        while True:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            running = self.running
+            data, count = self.take()
+            if count:
+                self.write(data, count)
+            if not running:
+                break
+        if self.segment is not None:
+            self.segment.close()
+            self.segment = None
+
+    def close(self):
+        """Write out what's left and close the segment"""
+        if not self.running:
+            return
+        self.running = False
+        self.wakeup.set()
+        self.thread.join(timeout=5)
+
+    def get_stats(self):
+        return dict(self.counters, backlog=self.head - self.tail, capacity=self.capacity,
+                    segment=self.segment_path)
+
+
+class FlightLog:
+    """One segment, memory-mapped; `records` is a RECORD_DTYPE array over the file.
+
+    A record cut short by a crash at the end of the file is ignored.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, record_size, self.start_time = HEADER.unpack_from(self.map)
+        if magic != MAGIC or record_size != RECORD.size:
+            self.map.close()
+            raise ValueError(f"Not a version {VERSION} flight log: {path}")
+        count = (len(self.map) - HEADER.size) // RECORD.size
+        self.records = np.frombuffer(self.map, RECORD_DTYPE, count, HEADER.size)
+
+    def between(self, start=None, end=None):
+        """Records with start <= timestamp < end, found by binary search"""
+        timestamps = self.records["timestamp"]
+        lo = 0 if start is None else np.searchsorted(timestamps, start)
+        hi = len(timestamps) if end is None else np.searchsorted(timestamps, end)
+        return self.records[lo:hi]
+
+    def close(self):
+        # The array is a view into the map, so drop it first
+        self.records = None
+        self.map.close()
+
+
+def segment_paths(directory):
+    return sorted(glob.glob(os.path.join(directory, "flight-*.rec")))
+
+
+def load(directory, kinds=None, start=None, end=None):
+    """Records from every segment in `directory`, optionally filtered, as one array"""
+    selected = []
+    for path in segment_paths(directory):
+        log = FlightLog(path)
+        records = log.between(start, end)
+        if kinds is not None:
+            records = records[np.isin(records["kind"], kinds)]
+        # Copied so the segment can be unmapped
+        selected.append(records.copy())
+        del records
+        log.close()
+    return np.concatenate(selected) if selected else np.empty(0, RECORD_DTYPE)
+
+
+def summarize(directory):
+    """Per-segment index: time range and record count per kind"""
+    segments = []
+    for path in segment_paths(directory):
+        log = FlightLog(path)
+        timestamps = log.records["timestamp"]
+        kinds, counts = np.unique(log.records["kind"], return_counts=True)
+        segments.append({
+            "path": path,
+            "records": len(timestamps),
+            "start": float(timestamps[0]) if len(timestamps) else log.start_time,
+            "end": float(timestamps[-1]) if len(timestamps) else log.start_time,
+            "kinds": {KINDS.get(int(kind), (str(kind),))[0]: int(count)
+                      for kind, count in zip(kinds, counts)},
+        })
+        del timestamps
+        log.close()
+    return segments
+
+
+def replay(records, speed=1.0):
+    """Yield records with their original spacing divided by `speed` (0 = no pacing)"""
+    if not len(records):
+        return
+    wall_start = time.monotonic()
+    log_start = records["timestamp"][0]
+    for record in records:
+        if speed:
+            delay = (record["timestamp"] - log_start) / speed - (time.monotonic() - wall_start)
+            if delay > 0:
+                time.sleep(delay)
+        yield record
+
+
+def format_record(record):
+    name = KINDS.get(int(record["kind"]), (str(record["kind"]),))[0]
+    stamp = time.strftime("%H:%M:%S", time.localtime(record["timestamp"]))
+    return (f"{stamp}.{int(record['timestamp'] % 1 * 1000):03d} {name:<10} "
+            f"code={record['code']} channel={record['channel']} seq={record['seq']} "
+            f"value={record['value']:g} extra={record['extra']:g}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect flight recorder logs")
+    parser.add_argument("action", choices=("summary", "replay"))
+    parser.add_argument("directory")
+    parser.add_argument("--kind", action="append", choices=sorted(KIND_IDS),
+                        help="only these record kinds (repeatable)")
+    parser.add_argument("--start", type=float, help="unix time to start from")
+    parser.add_argument("--end", type=float, help="unix time to stop at")
+    parser.add_argument("--speed", type=float, default=0,
+                        help="replay pacing, 1 = real time (default: as fast as possible)")
+    args = parser.parse_args()
+
+    if args.action == "summary":
+        for segment in summarize(args.directory):
+            print(f"{segment['path']}: {segment['records']} records, "
+                  f"{segment['end'] - segment['start']:.1f} s, {segment['kinds']}")
+        return
+    kinds = [KIND_IDS[name] for name in args.kind] if args.kind else None
+    records = load(args.directory, kinds, args.start, args.end)
+    for record in replay(records, args.speed):
+        print(format_record(record))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,367 @@
+"""GPIO backends and the cached output layer shared by the motor controllers.
+
+load_gpio() picks the driver behind MotorController: RPi.GPIO on the Pi, or
+SimulatedGPIO, which records timestamped pin and duty-cycle transitions
+instead of touching hardware. The simulator is only ever used when asked for
+with ROV_GPIO=sim (dev boxes, CI): if RPi.GPIO is missing or can't reach the
+pins, load_gpio() raises rather than quietly driving simulated thrusters.
+
+PWM is separate from the GPIO driver: SoftwarePWM is RPi.GPIO's threaded
+software PWM (the default), SysfsPWMBackend drives the SoC's hardware PWM
+channels through /sys/class/pwm. load_pwm_backend() picks one from
+ROV_PWM=software|sysfs, with ROV_PWM_FREQUENCY (Hz), ROV_PWM_RESOLUTION
+(duty steps, hardware only), ROV_PWM_CHIP and ROV_PWM_ROOT (point it at a
+fake sysfs tree to try it off the Pi; `python gpio_pins.py` does exactly that).
+
+The motor controllers used to rewrite both direction pins and the duty cycle
+on every command, even when nothing changed. PinStateCache remembers what
+was last written and only touches the hardware for values that differ; a
+motor's direction pins that do change go out in a single GPIO.output call.
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+
+from flight_recorder import KIND_GPIO_DUTY, KIND_GPIO_LEVEL
+
+GPIO_BACKENDS = ("rpi", "sim")
+PWM_BACKENDS = ("software", "sysfs")
+
+SYSFS_PWM_ROOT = "/sys/class/pwm"
+# BCM pins that can be muxed to the Pi's two hardware PWM channels
+# (dtoverlay=pwm-2chan,pin=12,func=4,pin2=13,func2=4 or the 18/19 pair)
+HARDWARE_PWM_CHANNELS = {12: 0, 18: 0, 13: 1, 19: 1}
+
+
+class SimulatedPWM:
+    def __init__(self, gpio, pin, frequency):
+        self.gpio = gpio
+        self.pin = pin
+        self.frequency = frequency
+
+    def start(self, duty_cycle):
+        self.gpio.record(self.pin, "duty", duty_cycle)
+
+    def ChangeDutyCycle(self, duty_cycle):
+        self.gpio.record(self.pin, "duty", duty_cycle)
+
+    def ChangeFrequency(self, frequency):
+        self.frequency = frequency
+
+    def stop(self):
+        self.gpio.record(self.pin, "duty", 0)
+
+
+class SimulatedGPIO:
+    """Drop-in for the RPi.GPIO module that records what the pins would do.
+
+    Every change of a pin level or duty cycle is appended to `transitions` as
+    (monotonic time, pin, 'level' | 'duty', value); writes that don't change
+    anything aren't transitions and aren't recorded. Listeners are called
+    with the same tuple, from whichever thread did the write.
+    """
+    BCM = 11
+    BOARD = 10
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+
+    def __init__(self, history=10000):
+        self.transitions = deque(maxlen=history)
+        self.listeners = []
+        self.state = {}
+        self.mode = None
+
+    def record(self, pin, kind, value):
+        if self.state.get((pin, kind)) == value:
+            return
+        self.state[(pin, kind)] = value
+        transition = (time.monotonic(), pin, kind, value)
+        self.transitions.append(transition)
+        for listener in self.listeners:
+            listener(transition)
+
+    def setwarnings(self, enabled):
+        pass
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setup(self, pin, direction, initial=-1):
+        if direction == self.OUT and initial != -1:
+            self.record(pin, "level", initial)
+
+    def output(self, pins, values):
+        # Same calling convention as RPi.GPIO: single values or sequences
+        if not isinstance(pins, (list, tuple)):
+            pins = [pins]
+        if not isinstance(values, (list, tuple)):
+            values = [values] * len(pins)
+        for pin, value in zip(pins, values):
+            self.record(pin, "level", int(value))
+
+    def PWM(self, pin, frequency):
+        return SimulatedPWM(self, pin, frequency)
+
+    def cleanup(self):
+        self.state.clear()
+
+
+def load_gpio(backend=None):
+    """The GPIO driver named by `backend` or $ROV_GPIO ('rpi' by default)"""
+    backend = backend or os.environ.get("ROV_GPIO", "rpi")
+    if backend not in GPIO_BACKENDS:
+        raise ValueError(f"Unknown GPIO backend: {backend}")
+    if backend == "sim":
+        return SimulatedGPIO()
+    try:
+        import RPi.GPIO as GPIO
+    except ImportError as e:
+        raise ImportError("RPi.GPIO isn't installed; set ROV_GPIO=sim to run without "
+                          "hardware") from e
+    # A RuntimeError from RPi.GPIO (not a Pi, no access to the pins) goes up as is
+    return GPIO
+
+
+class SoftwarePWM:
+    """RPi.GPIO's software PWM: one thread per pin, timing at Python's mercy"""
+    software = True
+
+    def __init__(self, gpio, frequency=100):
+        self.gpio = gpio
+        self.frequency = frequency
+
+    def PWM(self, pin):
+        return self.gpio.PWM(pin, self.frequency)
+
+
+class SysfsPWM:
+    """One kernel PWM channel with RPi.GPIO.PWM's interface.
+
+    Duty cycles are percentages, quantized to `resolution` steps of the
+    period. The duty_cycle file stays open so an update is a single pwrite.
+    """
+    def __init__(self, chip_path, channel, frequency, resolution):
+        self.path = os.path.join(chip_path, f"pwm{channel}")
+        if not os.path.isdir(self.path):
+            self.write(os.path.join(chip_path, "export"), channel)
+            # udev creates the channel directory asynchronously
+            deadline = time.monotonic() + 1
+            while not os.path.isdir(self.path):
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f"{self.path} did not appear after export")
+                time.sleep(0.01)
+        self.resolution = resolution
+        self.duty_fd = os.open(os.path.join(self.path, "duty_cycle"), os.O_WRONLY)
+        # Sysfs takes each write whole; a fake tree on a normal filesystem
+        # would keep a longer previous value's tail unless truncated
+        self.truncate = not os.path.realpath(self.path).startswith("/sys/")
+        self.duty_cycle = 0
+        self.period = None
+        self.ChangeFrequency(frequency)
+
+    def write(self, path, value):
+        with open(path, "w") as f:
+            f.write(str(value))
+
+    def write_duty(self, nanoseconds):
+        value = str(nanoseconds).encode()
+        os.pwrite(self.duty_fd, value, 0)
+        if self.truncate:
+            os.ftruncate(self.duty_fd, len(value))
+
+    def start(self, duty_cycle):
+        self.ChangeDutyCycle(duty_cycle)
+        self.write(os.path.join(self.path, "enable"), 1)
+
+    def ChangeDutyCycle(self, duty_cycle):
+        self.duty_cycle = duty_cycle
+        step = round(max(0, min(100, duty_cycle)) * self.resolution / 100)
+        self.write_duty(self.period * step // self.resolution)
+
+    def ChangeFrequency(self, frequency):
+        self.frequency = frequency
+        self.period = round(1e9 / frequency)
+        # The kernel rejects a period shorter than the current duty cycle
+        self.write_duty(0)
+        self.write(os.path.join(self.path, "period"), self.period)
+        self.ChangeDutyCycle(self.duty_cycle)
+
+    def stop(self):
+        self.write(os.path.join(self.path, "enable"), 0)
+
+
+class SysfsPWMBackend:
+    """Hardware PWM through /sys/class/pwm/pwmchipN.
+
+    The waveform comes from the PWM peripheral, so there is no thread per
+    motor, no jitter when Python is busy and frequencies well above 100 Hz
+    work. Only pins in HARDWARE_PWM_CHANNELS can be used, and only one pin per
+    channel: 12/18 and 13/19 would share a duty cycle, so at most two motors.
+    """
+    software = False
+
+    def __init__(self, root=SYSFS_PWM_ROOT, chip=0, frequency=100, resolution=1000):
+        self.chip_path = os.path.join(root, f"pwmchip{chip}")
+        self.frequency = frequency
+        self.resolution = resolution
+        # channel -> pin that claimed it
+        self.claimed = {}
+
+    def PWM(self, pin):
+        if pin not in HARDWARE_PWM_CHANNELS:
+            raise ValueError(f"GPIO{pin} has no hardware PWM channel "
+                             f"(use one of {sorted(HARDWARE_PWM_CHANNELS)})")
+        channel = HARDWARE_PWM_CHANNELS[pin]
+        if self.claimed.setdefault(channel, pin) != pin:
+            raise ValueError(f"GPIO{pin} and GPIO{self.claimed[channel]} share hardware "
+                             f"PWM channel {channel}; use software PWM for more than "
+                             f"one motor per channel")
+        return SysfsPWM(self.chip_path, HARDWARE_PWM_CHANNELS[pin],
+                        self.frequency, self.resolution)
+
+
+def load_pwm_backend(gpio, backend=None):
+    """The PWM driver named by `backend` or $ROV_PWM ('software' by default)"""
+    backend = backend or os.environ.get("ROV_PWM", "software")
+    frequency = float(os.environ.get("ROV_PWM_FREQUENCY", 100))
+    if backend == "software":
+        return SoftwarePWM(gpio, frequency)
+    if backend == "sysfs":
+        return SysfsPWMBackend(
+            root=os.environ.get("ROV_PWM_ROOT", SYSFS_PWM_ROOT),
+            chip=int(os.environ.get("ROV_PWM_CHIP", 0)),
+            frequency=frequency,
+            resolution=int(os.environ.get("ROV_PWM_RESOLUTION", 1000)),
+        )
+    raise ValueError(f"Unknown PWM backend: {backend} (expected one of {PWM_BACKENDS})")
+
+
+class PinStateCache:
+    def __init__(self, gpio, pwm_backend=None):
+        self.gpio = gpio
+        self.pwm_backend = pwm_backend or SoftwarePWM(gpio)
+        self.levels = {}
+        self.pwms = {}
+        self.duty_cycles = {}
+        # Flask serves requests from several threads
+        self.lock = threading.Lock()
+        self.counters = {"issued": 0, "suppressed": 0, "gpio_calls": 0}
+        # Optional FlightRecorder; gets one record per pin write that goes out
+        self.recorder = None
+
+    def setup_output(self, pin):
+        # Start from a known level so the cache matches the hardware
+        self.gpio.setup(pin, self.gpio.OUT, initial=self.gpio.LOW)
+        self.levels[pin] = self.gpio.LOW
+
+    def setup_pwm(self, pin):
+        if self.pwm_backend.software:
+            self.setup_output(pin)
+        # Hardware PWM pins stay on their PWM alt function, not GPIO output
+        pwm = self.pwm_backend.PWM(pin)
+        pwm.start(0)
+        self.pwms[pin] = pwm
+        self.duty_cycles[pin] = 0
+        return pwm
+
+    def update(self, levels=(), pwm_pin=None, duty_cycle=None):
+        """Apply one motor's pin levels ((pin, level) pairs) and duty cycle.
+
+        Direction pins are written before the duty cycle, as before.
+        """
+        duty_cycles = () if pwm_pin is None else ((pwm_pin, duty_cycle),)
+        self.apply(levels, duty_cycles)
+
+    def apply(self, levels=(), duty_cycles=()):
+        """Apply (pin, level) and (pwm pin, duty cycle) pairs for any number of motors.
+
+        All changed levels go out in one GPIO.output call, then the changed
+        duty cycles.
+        """
+        with self.lock:
+            levels = list(levels)
+            changed = [(pin, level) for pin, level in levels if self.levels.get(pin) != level]
+            self.counters["suppressed"] += len(levels) - len(changed)
+            if changed:
+                pins, values = zip(*changed)
+                self.gpio.output(list(pins), list(values))
+                self.levels.update(changed)
+                self.counters["issued"] += len(changed)
+                self.counters["gpio_calls"] += 1
+                if self.recorder:
+                    for pin, level in changed:
+                        self.recorder.record(KIND_GPIO_LEVEL, channel=pin, value=level)
+
+            for pwm_pin, duty_cycle in duty_cycles:
+                if self.duty_cycles.get(pwm_pin) == duty_cycle:
+                    self.counters["suppressed"] += 1
+                    continue
+                self.pwms[pwm_pin].ChangeDutyCycle(duty_cycle)
+                self.duty_cycles[pwm_pin] = duty_cycle
+                self.counters["issued"] += 1
+                self.counters["gpio_calls"] += 1
+                if self.recorder:
+                    self.recorder.record(KIND_GPIO_DUTY, channel=pwm_pin, value=duty_cycle)
+
+    def cleanup(self):
+        with self.lock:
+            if not self.pwm_backend.software:
+                # GPIO.cleanup() doesn't know about the PWM peripheral
+                for pwm in self.pwms.values():
+                    pwm.stop()
+            self.gpio.cleanup()
+            # Hardware state is unknown now, so the next writes always go out
+            self.levels.clear()
+            self.duty_cycles.clear()
+
+    def get_stats(self):
+        return dict(
+            self.counters,
+            pwm_backend=type(self.pwm_backend).__name__,
+            pwm_frequency=self.pwm_backend.frequency,
+        )
+
+
+def make_fake_sysfs_pwm(root, chip=0, channels=2):
+    """A /sys/class/pwm stand-in with already exported channels"""
+    chip_path = os.path.join(root, f"pwmchip{chip}")
+    os.makedirs(chip_path, exist_ok=True)
+    for name, value in (("export", ""), ("unexport", ""), ("npwm", channels)):
+        with open(os.path.join(chip_path, name), "w") as f:
+            f.write(str(value))
+    for channel in range(channels):
+        channel_path = os.path.join(chip_path, f"pwm{channel}")
+        os.makedirs(channel_path, exist_ok=True)
+        for name in ("period", "duty_cycle", "enable"):
+            with open(os.path.join(channel_path, name), "w") as f:
+                f.write("0")
+    return chip_path
+
+
+def main():
+    """Drive the sysfs backend against a fake tree: python gpio_pins.py [frequency]"""
+    frequency = float(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    with tempfile.TemporaryDirectory() as root:
+        chip_path = make_fake_sysfs_pwm(root)
+        pins = PinStateCache(SimulatedGPIO(), SysfsPWMBackend(root, frequency=frequency))
+        pins.setup_pwm(12)
+        pins.setup_pwm(13)
+        pins.update(pwm_pin=12, duty_cycle=37.5)
+        pins.update(pwm_pin=13, duty_cycle=100)
+        pins.update(pwm_pin=13, duty_cycle=5)
+        for channel in (0, 1):
+            values = {}
+            for name in ("period", "duty_cycle", "enable"):
+                with open(os.path.join(chip_path, f"pwm{channel}", name)) as f:
+                    values[name] = f.read().strip()
+            print(f"pwm{channel}: {values}")
+        print(pins.get_stats())
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,25 @@
-from flask import Flask, request, jsonify, send_from_directory, render_template
-import RPi.GPIO as GPIO
+import tornado.ioloop
+import tornado.web
+import tornado.websocket
+import argparse
+import json
 import os
 
-app = Flask(__name__)
+import rov_log
+from gpio_pins import PinStateCache, load_gpio, load_pwm_backend
+from thrusters import load_topology
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+DIRECTIONS = ("forward", "backward", "off")
+
+log = rov_log.get_logger("MOTOR")
+
+# RPi.GPIO on the Pi; set ROV_GPIO=sim to run without hardware
+GPIO = load_gpio()
+
+# Only writes pin levels/duty cycles that actually change; software PWM
+# unless ROV_PWM=sysfs picks the hardware channels
+pins = PinStateCache(GPIO, load_pwm_backend(GPIO))
 
 # Motor control class with GPIO setup
 class MotorController:
@@ -17,94 +34,264 @@ class MotorController:
         # GPIO setup for the motor
         GPIO.setwarnings(False)
         GPIO.setmode(GPIO.BCM)
-        GPIO.setup(self.input1, GPIO.OUT)
-        GPIO.setup(self.input2, GPIO.OUT)
-        GPIO.setup(self.pwm_pin, GPIO.OUT)
+        pins.setup_output(self.input1)
+        pins.setup_output(self.input2)
 
         # Set up PWM for the motor
-        self.pwm = GPIO.PWM(self.pwm_pin, 100)
-        self.pwm.start(0)
+        self.pwm = pins.setup_pwm(self.pwm_pin)
+
+    def direction_levels(self, direction):
+        """(pin, level) pairs for a direction: forward, backward or off"""
+        level1, level2 = {
+            "forward": (GPIO.HIGH, GPIO.LOW),
+            "backward": (GPIO.LOW, GPIO.HIGH),
+            "off": (GPIO.LOW, GPIO.LOW),
+        }[direction]
+        return ((self.input1, level1), (self.input2, level2))
+
+    def set_direction(self, direction):
+        pins.update(self.direction_levels(direction))
+        self.current_state = direction
+        broadcaster.notify()
 
     def motor_forward(self):
-        GPIO.output(self.input1, GPIO.HIGH)
-        GPIO.output(self.input2, GPIO.LOW)
-        self.current_state = "forward"
+        self.set_direction("forward")
 
     def motor_backward(self):
-        GPIO.output(self.input1, GPIO.LOW)
-        GPIO.output(self.input2, GPIO.HIGH)
-        self.current_state = "backward"
+        self.set_direction("backward")
 
     def motor_off(self):
-        GPIO.output(self.input1, GPIO.LOW)
-        GPIO.output(self.input2, GPIO.LOW)
-        self.current_state = "off"
+        self.set_direction("off")
 
     def set_pwm(self, value):
         self.pwm_value = max(0, min(100, value))
-        self.pwm.ChangeDutyCycle(self.pwm_value)
+        pins.update(pwm_pin=self.pwm_pin, duty_cycle=self.pwm_value)
+        broadcaster.notify()
 
     def get_state(self):
         return {"name": self.name, "state": self.current_state, "pwm": self.pwm_value}
 
-# Initialize motors dynamically
+# Initialize motors from thrusters.json (or $ROV_THRUSTERS)
 motors = {
-    "motor1": MotorController("Motor 1", input1=17, input2=27, pwm_pin=4),
-    "motor2": MotorController("Motor 2", input1=5, input2=6, pwm_pin=13)
+    thruster["name"]: MotorController(thruster["label"], thruster["input1"],
+                                      thruster["input2"], thruster["pwm_pin"])
+    for thruster in load_topology()
 }
 
-# Serve the index.html file
-@app.route('/')
-def home():
-    return send_from_directory(os.getcwd(), 'templates/index.html')
 
-@app.route('/state', methods=['GET'])
 def get_states():
-    states = {motor_name: motor.get_state() for motor_name, motor in motors.items()}
-    return jsonify(states)
-
-@app.route('/<motor_name>/forward', methods=['GET'])
-def motor_forward(motor_name):
-    if motor_name in motors:
-        motors[motor_name].motor_forward()
-        return jsonify({motor_name: motors[motor_name].get_state()})
-    else:
-        return "Motor not found", 404
-
-@app.route('/<motor_name>/backward', methods=['GET'])
-def motor_backward(motor_name):
-    if motor_name in motors:
-        motors[motor_name].motor_backward()
-        return jsonify({motor_name: motors[motor_name].get_state()})
-    else:
-        return "Motor not found", 404
-
-@app.route('/<motor_name>/off', methods=['GET'])
-def motor_off(motor_name):
-    if motor_name in motors:
-        motors[motor_name].motor_off()
-        return jsonify({motor_name: motors[motor_name].get_state()})
-    else:
-        return "Motor not found", 404
-
-@app.route('/<motor_name>/pwm', methods=['GET'])
-def set_pwm(motor_name):
-    if motor_name in motors:
-        pwm_value = request.args.get('value', default=0, type=int)
-        motors[motor_name].set_pwm(pwm_value)
-        return jsonify({motor_name: motors[motor_name].get_state()})
-    else:
-        return "Motor not found", 404
-
-@app.route('/cleanup', methods=['GET'])
-def gpio_cleanup():
-    GPIO.cleanup()
-    return "GPIO cleaned up"
-
-# Run the Flask server
+    return {motor_name: motor.get_state() for motor_name, motor in motors.items()}
+
+
+class StateBroadcaster:
+    """Pushes motor state changes to every subscribed /ws observer.
+
+    Changes are coalesced to at most one message per `interval`. Each message
+    carries only the fields that differ from the previous broadcast and is
+    serialized once for all observers.
+    """
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.observers = set()
+        self.last_states = {}
+        self.last_flush = 0.0
+        self.pending = False
+        self.counters = {"changes": 0, "broadcasts": 0, "messages": 0}
+
+    def subscribe(self, observer):
+        states = get_states()
+        if not self.pending:
+            # Nothing unsent, so every existing observer already has this
+            self.last_states = states
+        self.observers.add(observer)
+        observer.write_message(json.dumps({"type": "state", "data": states}))
+
+    def unsubscribe(self, observer):
+        self.observers.discard(observer)
+
+    def notify(self):
+        """Call after changing a motor; schedules a coalesced broadcast"""
+        self.counters["changes"] += 1
+        if self.pending or not self.observers:
+            return
+        self.pending = True
+        io_loop = tornado.ioloop.IOLoop.current()
+        io_loop.call_at(max(io_loop.time(), self.last_flush + self.interval), self.flush)
+
+    def flush(self):
+        self.pending = False
+        self.last_flush = tornado.ioloop.IOLoop.current().time()
+        states = get_states()
+        delta = {}
+        for motor_name, state in states.items():
+            last = self.last_states.get(motor_name, {})
+            changed = {key: value for key, value in state.items() if last.get(key) != value}
+            if changed:
+                delta[motor_name] = changed
+        self.last_states = states
+        if not delta:
+            return
+        message = json.dumps({"type": "state_delta", "data": delta})
+        self.counters["broadcasts"] += 1
+        for observer in list(self.observers):
+            try:
+                observer.write_message(message)
+                self.counters["messages"] += 1
+            except tornado.websocket.WebSocketClosedError:
+                self.unsubscribe(observer)
+
+    def get_stats(self):
+        return dict(self.counters, observers=len(self.observers))
+
+
+broadcaster = StateBroadcaster()
+
+
+def set_motors(changes):
+    """Set several motors at once: {"motor1": {"state": "forward", "pwm": 60}, ...}
+
+    Everything is validated before anything is written, and all direction
+    pins then go out in a single GPIO write, so a batch applies completely or
+    not at all. Raises ValueError for unknown motors or bad values.
+    """
+    if not isinstance(changes, dict):
+        raise ValueError("Expected a JSON object of motor changes")
+    levels, duty_cycles, updates = [], [], []
+    for motor_name, change in changes.items():
+        if motor_name not in motors:
+            raise ValueError(f"Motor not found: {motor_name}")
+        if not isinstance(change, dict):
+            raise ValueError(f"Expected an object of changes for {motor_name}")
+        motor = motors[motor_name]
+        direction = change.get("state", motor.current_state)
+        if direction not in DIRECTIONS:
+            raise ValueError(f"Bad state for {motor_name}: {direction}")
+        try:
+            pwm_value = max(0, min(100, int(change.get("pwm", motor.pwm_value))))
+        except (TypeError, ValueError, OverflowError):
+            raise ValueError(f"Bad pwm for {motor_name}: {change.get('pwm')}")
+        levels.extend(motor.direction_levels(direction))
+        duty_cycles.append((motor.pwm_pin, pwm_value))
+        updates.append((motor, direction, pwm_value))
+
+    pins.apply(levels, duty_cycles)
+    for motor, direction, pwm_value in updates:
+        motor.current_state = direction
+        motor.pwm_value = pwm_value
+    broadcaster.notify()
+    return {motor_name: motors[motor_name].get_state() for motor_name in changes}
+
+
+# Serve the index.html file
+class HomeHandler(tornado.web.RequestHandler):
+    def get(self):
+        with open(os.path.join(ROOT, 'templates', 'index.html'), 'rb') as f:
+            self.set_header('Content-Type', 'text/html; charset=utf-8')
+            self.write(f.read())
+
+
+class StateHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.write(get_states())
+
+
+class MotorHandler(tornado.web.RequestHandler):
+    """The original one-action-per-request routes: /<motor_name>/<action>"""
+    def get(self, motor_name, action):
+        if motor_name not in motors:
+            self.set_status(404)
+            self.write("Motor not found")
+            return
+        motor = motors[motor_name]
+        if action == 'pwm':
+            try:
+                pwm_value = int(self.get_argument('value', '0'))
+            except ValueError:
+                pwm_value = 0
+            motor.set_pwm(pwm_value)
+        else:
+            motor.set_direction(action)
+        self.write({motor_name: motor.get_state()})
+
+
+class BatchHandler(tornado.web.RequestHandler):
+    """POST /motors with a JSON body for set_motors(); one round trip for many motors"""
+    def post(self):
+        try:
+            self.write(set_motors(json.loads(self.request.body)))
+        except ValueError as e:
+            self.set_status(400)
+            self.write({"error": str(e)})
+
+
+class ControlWebSocket(tornado.websocket.WebSocketHandler):
+    """Same batches as POST /motors over one long-lived connection.
+
+    After {"type": "subscribe"} the connection gets a full "state" snapshot
+    and then "state_delta" pushes, so it no longer needs replies or polling.
+    """
+    def check_origin(self, origin):
+        return True
+
+    def open(self):
+        self.subscribed = False
+
+    def on_message(self, message):
+        try:
+            data = json.loads(message)
+            if not isinstance(data, dict):
+                raise ValueError("Expected a JSON object message")
+            if data.get('type') == 'set_motors':
+                states = set_motors(data.get('data', {}))
+                if not self.subscribed:
+                    self.write_message({'type': 'motors', 'data': states})
+            elif data.get('type') == 'subscribe':
+                self.subscribed = True
+                broadcaster.subscribe(self)
+            elif data.get('type') == 'get_state':
+                self.write_message({'type': 'motors', 'data': get_states()})
+        except ValueError as e:
+            self.write_message({'type': 'error', 'data': {'error': str(e)}})
+
+    def on_close(self):
+        broadcaster.unsubscribe(self)
+
+
+class GpioStatsHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.write(dict(pins.get_stats(), broadcaster=broadcaster.get_stats(),
+                        log=rov_log.get_stats()))
+
+
+class CleanupHandler(tornado.web.RequestHandler):
+    def get(self):
+        pins.cleanup()
+        self.write("GPIO cleaned up")
+
+
+def make_app():
+    return tornado.web.Application([
+        (r'/', HomeHandler),
+        (r'/state', StateHandler),
+        (r'/motors', BatchHandler),
+        (r'/ws', ControlWebSocket),
+        (r'/gpio_stats', GpioStatsHandler),
+        (r'/cleanup', CleanupHandler),
+        (r'/([^/]+)/(forward|backward|off|pwm)', MotorHandler),
+    ], static_path=os.path.join(ROOT, 'static'))
+
+
+# Run the server: one process, so GPIO is only initialized once (the Flask
+# debug reloader used to start a second one)
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ROV motor control server")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    args = parser.parse_args()
     try:
-        app.run(host='0.0.0.0', port=5000, debug=True)
+        make_app().listen(args.port, address=args.host)
+        log.info("starting", f"Motor control server on http://{args.host}:{args.port}")
+        tornado.ioloop.IOLoop.current().start()
     except KeyboardInterrupt:
-        GPIO.cleanup()
-        print("GPIO Clean up")
+        pins.cleanup()
+        log.info("cleanup", "GPIO Clean up")
@@ -1,8 +1,14 @@
 from flask import Flask, request, jsonify
-import RPi.GPIO as GPIO
+
+import rov_log
+from gpio_pins import load_gpio
 
 app = Flask(__name__)
 
+# RPi.GPIO on the Pi; set ROV_GPIO=sim to run without hardware
+GPIO = load_gpio()
+log = rov_log.get_logger("MOTOR")
+
 # Motor control class with GPIO setup
 class MotorController:
     def __init__(self, name, input1, input2, pwm_pin):
@@ -28,24 +34,24 @@ class MotorController:
         GPIO.output(self.input1, GPIO.HIGH)
         GPIO.output(self.input2, GPIO.LOW)
         self.current_state = "forward"
-        print(f"{self.name} moving forward")
+        log.info("motor_state", f"{self.name} moving forward", rate=5)
 
     def motor_backward(self):
         GPIO.output(self.input1, GPIO.LOW)
         GPIO.output(self.input2, GPIO.HIGH)
         self.current_state = "backward"
-        print(f"{self.name} moving backward")
+        log.info("motor_state", f"{self.name} moving backward", rate=5)
 
     def motor_off(self):
         GPIO.output(self.input1, GPIO.LOW)
         GPIO.output(self.input2, GPIO.LOW)
         self.current_state = "off"
-        print(f"{self.name} off")
+        log.info("motor_state", f"{self.name} off", rate=5)
 
     def set_pwm(self, value):
         self.pwm_value = max(0, min(100, value))
         self.pwm.ChangeDutyCycle(self.pwm_value)
-        print(f"{self.name} PWM set to {self.pwm_value}")
+        log.info("motor_pwm", f"{self.name} PWM set to {self.pwm_value}", rate=5)
 
     def get_state(self):
         return {"name": self.name, "state": self.current_state, "pwm": self.pwm_value}
@@ -110,4 +116,4 @@ if __name__ == "__main__":
         app.run(host='0.0.0.0', port=80, debug=True)
     except KeyboardInterrupt:
         GPIO.cleanup()
-        print("GPIO Clean up")
+        log.info("cleanup", "GPIO Clean up")
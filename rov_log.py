@@ -0,0 +1,139 @@
+"""Non-blocking structured logging for the servers.
+
+    log = get_logger("SERVER")
+    log.info("movement_command", "Movement command", rate=2, command="forward", power=80)
+
+Calls only build a tuple and put it on a bounded queue; a background thread
+formats and writes records in batches, so a slow console or SD card never
+stalls the control path. If the queue is full the record is dropped and
+counted instead of blocking. `rate` caps an event at that many records per
+second (per logger); the next record that gets through carries how many
+were suppressed in between.
+
+ROV_LOG_LEVEL (debug/info/warning/error, default info) sets the threshold
+and ROV_LOG_FORMAT=json switches from text lines to one JSON object per line.
+"""
+import atexit
+import json
+import os
+import queue
+import sys
+import threading
+import time
+
+LEVELS = {"debug": 10, "info": 20, "warning": 30, "error": 40}
+
+
+class LogWriter:
+    """The shared queue and writer thread behind every Logger"""
+
+    def __init__(self, max_queue=1000, json_lines=False):
+        self.queue = queue.Queue(max_queue)
+        self.json_lines = json_lines
+        self.counters = {"written": 0, "dropped": 0, "suppressed": 0}
+        self.thread = threading.Thread(target=self.run, name="rov-log", daemon=True)
+        self.thread.start()
+        atexit.register(self.flush)
+
+    def put(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.counters["dropped"] += 1
+
+    def format(self, record):
+        timestamp, source, level, event, message, fields = record
+        if self.json_lines:
+            return json.dumps(dict(
+                fields, ts=round(timestamp, 6), source=source, level=level,
+                event=event, msg=message), default=str)
+        text = f"[{source}] {message}"
+        if level != "info":
+            text = f"[{source}] {level.upper()}: {message}"
+        if fields:
+            text += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        return text
+
+    def run(self):
+        while True:
+            records = [self.queue.get()]
+            # Drain whatever else is waiting so a burst is one write + flush
+            while len(records) < 100:
+                try:
+                    records.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            lines = "".join(self.format(record) + "\n" for record in records)
+            try:
+                # Looked up per batch so contextlib.redirect_stdout applies
+                sys.stdout.write(lines)
+                sys.stdout.flush()
+            except (OSError, ValueError):
+                pass
+            self.counters["written"] += len(records)
+            for _ in records:
+                self.queue.task_done()
+
+    def flush(self, timeout=1.0):
+        """Wait (bounded) for queued records to be written, e.g. at exit"""
+        deadline = time.monotonic() + timeout
+        while self.queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.005)
+
+    def get_stats(self):
+        return dict(self.counters, queued=self.queue.qsize())
+
+
+class Logger:
+    def __init__(self, source, writer, level="info"):
+        self.source = source
+        self.writer = writer
+        self.level = LEVELS[level]
+        # event -> [window start, records in window, suppressed since last record]
+        self.rates = {}
+
+    def log(self, level, event, message="", rate=None, **fields):
+        if LEVELS[level] < self.level:
+            return
+        if rate is not None:
+            now = time.monotonic()
+            window = self.rates.setdefault(event, [now, 0, 0])
+            if now - window[0] >= 1.0:
+                window[0], window[1] = now, 0
+            if window[1] >= rate:
+                window[2] += 1
+                self.writer.counters["suppressed"] += 1
+                return
+            window[1] += 1
+            if window[2]:
+                fields["suppressed"], window[2] = window[2], 0
+        self.writer.put((time.time(), self.source, level, event, message, fields))
+
+    def debug(self, event, message="", **fields):
+        self.log("debug", event, message, **fields)
+
+    def info(self, event, message="", **fields):
+        self.log("info", event, message, **fields)
+
+    def warning(self, event, message="", **fields):
+        self.log("warning", event, message, **fields)
+
+    def error(self, event, message="", **fields):
+        self.log("error", event, message, **fields)
+
+
+writer = None
+writer_lock = threading.Lock()
+
+
+def get_logger(source):
+    global writer
+    with writer_lock:
+        if writer is None:
+            writer = LogWriter(json_lines=os.environ.get("ROV_LOG_FORMAT") == "json")
+    return Logger(source, writer, os.environ.get("ROV_LOG_LEVEL", "info"))
+
+
+def get_stats():
+    """Written/dropped/suppressed record counts for the process"""
+    return writer.get_stats() if writer else {}
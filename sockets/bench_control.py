@@ -0,0 +1,185 @@
+"""Command-to-actuation latency benchmark for the motor control path; no Pi needed.
+
+Runs server_rasp's websocket server in-process on the simulated GPIO driver
+(see gpio_pins.py) while a client streams movement commands at --rate, with
+optional video clients adding load. Every command carries a fresh power
+value, so it shows up as its own duty-cycle transition on the first thruster's
+PWM pin; latency runs from the client's send to that transition, i.e. it
+includes the websocket hop, message parsing and the control loop's tick.
+
+    python bench_control.py --format binary --rate 200 --video-clients 2 --output control.json
+
+Commands replaced by a newer one before the control loop's next tick never
+reach the pins; they are counted as `superseded` rather than as latency.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import sys
+import time
+
+import numpy as np
+import tornado.httpserver
+import tornado.testing
+import tornado.websocket
+
+# Must be chosen before server_rasp builds its motors
+os.environ['ROV_GPIO'] = 'sim'
+
+import server
+import server_rasp
+from bench_video import read_client
+
+
+def summarize(latencies, commands, elapsed):
+    latencies_ms = np.array(latencies) * 1000 if latencies else np.zeros(1)
+    return {
+        'commands': commands,
+        'actuated': len(latencies),
+        'superseded': commands - len(latencies),
+        'rate': round(commands / elapsed, 1) if elapsed else 0.0,
+        'latency_p50_ms': round(float(np.percentile(latencies_ms, 50)), 3),
+        'latency_p90_ms': round(float(np.percentile(latencies_ms, 90)), 3),
+        'latency_p99_ms': round(float(np.percentile(latencies_ms, 99)), 3),
+        'latency_max_ms': round(float(latencies_ms.max()), 3),
+    }
+
+
+async def drive_commands(url, args, sent):
+    connection = await tornado.websocket.websocket_connect(url)
+    await connection.read_message()  # connection_status
+    if args.format == 'binary':
+        connection.write_message(json.dumps({
+            'type': 'control_format',
+            'data': {'format': 'binary', 'acks': args.acks},
+        }))
+        await connection.read_message()
+
+    async def drain_acks():
+        while await connection.read_message() is not None:
+            pass
+
+    reader = asyncio.create_task(drain_acks())
+    commands = 0
+    period = 1 / args.rate
+    start = next_send = time.monotonic()
+    while time.monotonic() - start < args.seconds:
+        commands += 1
+        power = 1 + commands % 100
+        sent[power] = time.monotonic()
+        if args.format == 'binary':
+            connection.write_message(server.CONTROL_PACKET.pack(
+                server.CONTROL_OP_MOVE, server.MOVEMENT_COMMANDS.index('forward'),
+                power, args.lease_ms, commands), binary=True)
+        else:
+            connection.write_message(json.dumps({
+                'type': 'movement_command',
+                'data': {'command': 'forward', 'power': power, 'lease_ms': args.lease_ms},
+            }))
+        next_send += period
+        await asyncio.sleep(max(0.0, next_send - time.monotonic()))
+    elapsed = time.monotonic() - start
+
+    # Let the last command actuate before hanging up
+    await asyncio.sleep(2 / server_rasp.AsyncRobotWebSocket.control_loop.rate_hz)
+    connection.close()
+    reader.cancel()
+    return commands, elapsed
+
+
+async def bench(args):
+    handler = server_rasp.AsyncRobotWebSocket
+    handler.video_stream.source = args.source
+    handler.control_loop.rate_hz = args.control_rate
+    handler.control_loop.start()
+    recorder = None
+    if args.record:
+        recorder = server.start_recorder(args.record, handler)
+        handler.control_loop.recorder = server_rasp.pins.recorder = recorder
+
+    sock, port = tornado.testing.bind_unused_port()
+    http_server = tornado.httpserver.HTTPServer(server.make_app(handler))
+    http_server.add_sockets([sock])
+    url = f'ws://127.0.0.1:{port}/ws'
+
+    # Match each duty-cycle transition on the first thruster's PWM pin to its command
+    pwm_pin = next(iter(handler.robot_controller.motors.values())).pwm_pin
+    sent, latencies = {}, []
+
+    def on_transition(transition):
+        timestamp, pin, kind, value = transition
+        if pin == pwm_pin and kind == 'duty' and value in sent:
+            latencies.append(timestamp - sent.pop(value))
+
+    server_rasp.GPIO.listeners.append(on_transition)
+
+    video = [asyncio.create_task(read_client(url, {'format': 'binary'},
+                                             args.seconds + args.warmup))
+             for _ in range(args.video_clients)]
+    await asyncio.sleep(args.warmup if video else 0)
+
+    cpu_start = time.process_time()
+    commands, elapsed = await drive_commands(url, args, sent)
+    cpu = time.process_time() - cpu_start
+
+    results = summarize(latencies, commands, elapsed)
+    results['cpu_ms_per_command'] = round(1000 * cpu / commands, 3) if commands else 0.0
+    results['control'] = handler.control_loop.get_stats()
+    if video:
+        frames = [len(sizes) for _, sizes in await asyncio.gather(*video)]
+        results['video_frames_per_client'] = frames
+    if recorder:
+        recorder.close()
+        results['recorder'] = recorder.get_stats()
+
+    server_rasp.GPIO.listeners.remove(on_transition)
+    handler.control_loop.stop()
+    handler.video_stream.stop()
+    http_server.stop()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--seconds', type=float, default=5.0)
+    parser.add_argument('--rate', type=float, default=100,
+                        help="movement commands per second")
+    parser.add_argument('--format', choices=server.CONTROL_FORMATS, default='binary')
+    parser.add_argument('--acks', choices=server.ACK_MODES, default='on_change')
+    parser.add_argument('--lease-ms', type=int, default=1000)
+    parser.add_argument('--control-rate', type=float, default=100)
+    parser.add_argument('--video-clients', type=int, default=0,
+                        help="websocket video clients streaming alongside, for load")
+    parser.add_argument('--source', default='synthetic',
+                        help="frame source for the video clients")
+    parser.add_argument('--warmup', type=float, default=1.0)
+    parser.add_argument('--record', metavar='DIR',
+                        help="run with the flight recorder writing here, to measure its cost")
+    parser.add_argument('--output', help="write JSON results here instead of stdout")
+    args = parser.parse_args()
+
+    results = {
+        'timestamp': time.time(),
+        'config': vars(args),
+        'platform': {
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+        },
+    }
+    # Server logging goes to stderr so stdout stays machine-readable
+    with contextlib.redirect_stdout(sys.stderr):
+        results['websocket'] = asyncio.run(bench(args))
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+"""Offline benchmark for the video pipeline; no camera needed.
+
+Runs VideoStream against a synthetic or recorded frame source in two stages:
+
+* encode   - capture_and_encode_frame() in a tight, unpaced loop
+* pipeline - capture thread -> encoder pool -> FrameHub -> websocket clients,
+             end to end over a local socket
+
+and reports fps, p50/p99 capture-to-client latency, bytes per frame and CPU
+per frame. Results go to stdout (or --output) as JSON so runs can be compared
+between releases, e.g.:
+
+    python bench_video.py --source synthetic:noise --clients 2 --output bench.json
+
+CPU figures are for the whole process, which includes the benchmark's own
+websocket clients.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import platform
+import sys
+import time
+
+import cv2
+import numpy as np
+import tornado.httpserver
+import tornado.testing
+import tornado.websocket
+
+import server
+
+
+def summarize(latencies, sizes, frames, elapsed, cpu):
+    latencies_ms = np.array(latencies) * 1000 if latencies else np.zeros(1)
+    return {
+        'frames': frames,
+        'fps': round(frames / elapsed, 2) if elapsed else 0.0,
+        'latency_p50_ms': round(float(np.percentile(latencies_ms, 50)), 2),
+        'latency_p99_ms': round(float(np.percentile(latencies_ms, 99)), 2),
+        'latency_max_ms': round(float(latencies_ms.max()), 2),
+        'bytes_per_frame': round(float(np.mean(sizes)), 1) if sizes else 0.0,
+        'cpu_ms_per_frame': round(1000 * cpu / frames, 3) if frames else 0.0,
+    }
+
+
+def bench_encode(args):
+    stream = server.VideoStream(source=args.source)
+    if not stream.initialize_camera():
+        raise RuntimeError(stream.initialization_error)
+    # Unpaced, so this measures how fast one thread can capture + encode
+    stream.cap.set(cv2.CAP_PROP_FPS, 0)
+
+    latencies, sizes = [], []
+    cpu_start = time.process_time()
+    start = time.monotonic()
+    while time.monotonic() - start < args.seconds:
+        frame_start = time.monotonic()
+        frame_data = stream.capture_and_encode_frame()
+        if frame_data is not None:
+            latencies.append(time.monotonic() - frame_start)
+            sizes.append(len(frame_data))
+    elapsed = time.monotonic() - start
+    cpu = time.process_time() - cpu_start
+    stream.stop()
+    return summarize(latencies, sizes, len(sizes), elapsed, cpu)
+
+
+async def read_client(url, options, seconds):
+    connection = await tornado.websocket.websocket_connect(url)
+    await connection.read_message()  # connection_status
+    connection.write_message(json.dumps({'type': 'start_video', 'data': options}))
+
+    latencies, sizes = [], []
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        try:
+            message = await asyncio.wait_for(connection.read_message(),
+                                             deadline - time.monotonic())
+        except asyncio.TimeoutError:
+            break
+        if message is None:
+            break
+        received = time.time()
+        if isinstance(message, bytes):
+            header = server.VIDEO_HEADER.unpack_from(message)
+            timestamp, payload_size = header[3], len(message) - header[1]
+        else:
+            data = json.loads(message)
+            if data.get('type') != 'video_frame':
+                continue
+            timestamp, payload_size = data['data']['timestamp'], len(message)
+        latencies.append(received - timestamp)
+        sizes.append(payload_size)
+    connection.close()
+    return latencies, sizes
+
+
+async def bench_pipeline(args):
+    stream = server.VideoStream(source=args.source, encoder_workers=args.encoder_workers,
+                                change_threshold=args.change_threshold)
+    stream.abr.enabled = not args.fixed_quality
+    server.AsyncRobotWebSocket.video_stream = stream
+
+    sock, port = tornado.testing.bind_unused_port()
+    http_server = tornado.httpserver.HTTPServer(server.make_app())
+    http_server.add_sockets([sock])
+
+    options = {'format': args.format, 'codec': args.codec}
+    url = f'ws://127.0.0.1:{port}/ws'
+    # Let the stream warm up before measuring
+    await read_client(url, options, args.warmup)
+
+    cpu_start = time.process_time()
+    published_start = stream.counters['published']
+    start = time.monotonic()
+    results = await asyncio.gather(*(read_client(url, options, args.seconds)
+                                     for _ in range(args.clients)))
+    elapsed = time.monotonic() - start
+    cpu = time.process_time() - cpu_start
+    published = stream.counters['published'] - published_start
+    stats = stream.get_stats()
+    http_server.stop()
+    stream.stop()
+
+    clients = [summarize(latencies, sizes, len(sizes), elapsed, 0.0)
+               for latencies, sizes in results]
+    all_latencies = [latency for latencies, _ in results for latency in latencies]
+    all_sizes = [size for _, sizes in results for size in sizes]
+    total = summarize(all_latencies, all_sizes, published, elapsed, cpu)
+    total['clients'] = clients
+    total['dropped'] = {key: stats[key] for key in
+                        ('busy_dropped', 'late_dropped', 'encode_failed')}
+    total['quality_level'] = stats['quality_level']
+    total['static_skipped'] = stats['static_skipped']
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--source', default='synthetic',
+                        help="synthetic[:gradient|noise|static], a video file, or camera[:N]")
+    parser.add_argument('--seconds', type=float, default=5.0)
+    parser.add_argument('--warmup', type=float, default=1.0)
+    parser.add_argument('--clients', type=int, default=1)
+    parser.add_argument('--format', choices=server.VIDEO_FORMATS, default='binary')
+    parser.add_argument('--codec', choices=sorted(server.ENCODERS), default='jpeg')
+    parser.add_argument('--encoder-workers', type=int, default=3)
+    parser.add_argument('--fixed-quality', action='store_true',
+                        help="disable the adaptive quality controller")
+    parser.add_argument('--skip-encode', action='store_true')
+    parser.add_argument('--change-threshold', type=float, default=10,
+                        help="static-scene frame skipping (0 = send every frame)")
+    parser.add_argument('--output', help="write JSON results here instead of stdout")
+    args = parser.parse_args()
+
+    results = {
+        'timestamp': time.time(),
+        'config': vars(args),
+        'platform': {
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'opencv': cv2.__version__,
+            'numpy': np.__version__,
+        },
+    }
+    # Server logging goes to stderr so stdout stays machine-readable
+    with contextlib.redirect_stdout(sys.stderr):
+        if not args.skip_encode:
+            print("[BENCH] encode stage...")
+            results['encode'] = bench_encode(args)
+        print("[BENCH] pipeline stage...")
+        results['pipeline'] = asyncio.run(bench_pipeline(args))
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,411 @@
+"""Video encoder backends for VideoStream.
+
+There are two kinds of encoder:
+
+* Per-frame encoders (JpegEncoder) turn one raw frame into one independent
+  image. VideoStream runs them on its encoder pool and keeps frame order.
+* Streaming encoders (H264Encoder) run on their own threads. They are fed
+  from the capture thread through submit() and hand encoded chunks back
+  through a callback as they come out.
+
+Add a backend by subclassing FrameEncoder and registering it in ENCODERS.
+"""
+import os
+import shutil
+import struct
+import subprocess
+import sys
+import threading
+import time
+from collections import deque
+
+import cv2
+import numpy as np
+
+# rov_log.py lives at the repo root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import rov_log
+
+log = rov_log.get_logger('SERVER')
+
+ANNEXB_START_CODE = b'\x00\x00\x00\x01'
+NAL_SPS = 7
+
+# FLV, as H264Encoder reads it from ffmpeg: a 9-byte header plus a 4-byte
+# previous-tag size, then tags of type (u8), body size (u24), timestamp in ms
+# (low u24 + high u8) and stream id (u24), each followed by its own size (u32)
+FLV_HEADER_SIZE = 13
+FLV_TAG = struct.Struct('>II3x')
+FLV_TAG_VIDEO = 9
+FLV_KEYFRAME = 1
+AVC_SEQUENCE_HEADER = 0
+AVC_NALU = 1
+
+
+def read_exact(stream, size):
+    """`size` bytes from a pipe, across as many reads as it takes; None at EOF"""
+    data = bytearray()
+    while len(data) < size:
+        try:
+            chunk = stream.read(size - len(data))
+        except (OSError, ValueError):
+            return None
+        if not chunk:
+            return None
+        data += chunk
+    return bytes(data)
+
+
+def avcc_parameter_sets(record):
+    """SPS/PPS from an AVCDecoderConfigurationRecord as Annex-B, plus the NAL length size"""
+    length_size = (record[4] & 0x03) + 1
+    units, offset = [], 5
+    for _ in range(2):  # SPS list, then PPS list
+        count = record[offset] & (0x1F if not units else 0xFF)
+        offset += 1
+        for _ in range(count):
+            size = int.from_bytes(record[offset:offset + 2], 'big')
+            units.append(record[offset + 2:offset + 2 + size])
+            offset += 2 + size
+    return b''.join(ANNEXB_START_CODE + unit for unit in units), length_size
+
+
+def avcc_to_annexb(data, length_size):
+    """Length-prefixed NAL units as Annex-B, and the set of NAL types seen"""
+    units, nal_types, offset = [], set(), 0
+    while offset + length_size <= len(data):
+        size = int.from_bytes(data[offset:offset + length_size], 'big')
+        offset += length_size
+        unit = data[offset:offset + size]
+        offset += size
+        if unit:
+            nal_types.add(unit[0] & 0x1F)
+            units += (ANNEXB_START_CODE, unit)
+    return b''.join(units), nal_types
+
+
+class BufferPool:
+    """Recycles scratch arrays (e.g. resize destinations) between frames.
+
+    Shared by the encoder threads; `allocations` only grows when the pool is
+    empty for a shape, so in steady state it stays flat.
+    """
+    def __init__(self, max_per_shape=4):
+        self.max_per_shape = max_per_shape
+        self.free = {}
+        self.lock = threading.Lock()
+        self.allocations = 0
+
+    def acquire(self, shape, dtype=np.uint8):
+        dtype = np.dtype(dtype)
+        with self.lock:
+            free = self.free.get((shape, dtype))
+            if free:
+                return free.pop()
+            self.allocations += 1
+        return np.empty(shape, dtype)
+
+    def release(self, array):
+        with self.lock:
+            free = self.free.setdefault((array.shape, array.dtype), [])
+            if len(free) < self.max_per_shape:
+                free.append(array)
+
+
+class JpegEncoder:
+    """Default per-frame encoder: optional resize, then cv2.imencode"""
+    codec = 'jpeg'
+    streaming = False
+
+    def __init__(self, buffer_pool):
+        self.buffer_pool = buffer_pool
+
+    def encode(self, frame, encode_params, frame_size):
+        if frame.shape[1::-1] == frame_size:
+            # Camera already delivers the negotiated size; encode in place
+            ok, buffer = cv2.imencode('.jpg', frame, encode_params)
+        else:
+            resized = self.buffer_pool.acquire((frame_size[1], frame_size[0], frame.shape[2]))
+            try:
+                cv2.resize(frame, frame_size, dst=resized)
+                ok, buffer = cv2.imencode('.jpg', resized, encode_params)
+            finally:
+                self.buffer_pool.release(resized)
+        # Raw JPEG bytes; base64 is left to the JSON fallback path
+        return buffer if ok else None
+
+
+class FrameEncoder:
+    """Interface for streaming encoders.
+
+    submit() is called from the capture thread with a frame buffer it is about
+    to reuse, so implementations must copy what they need and never block.
+    Output goes to on_chunk(payload, timestamp, keyframe) from the encoder's
+    own threads.
+    """
+    codec = None
+    streaming = True
+
+    def __init__(self, frame_size, fps, on_chunk):
+        self.frame_size = frame_size
+        self.fps = fps
+        self.on_chunk = on_chunk
+
+    def start(self):
+        pass
+
+    def submit(self, frame, timestamp):
+        raise NotImplementedError
+
+    def stop(self):
+        pass
+
+    def get_stats(self):
+        return {}
+
+
+class LatestFrameEncoder(FrameEncoder):
+    """Streaming encoder that keeps only the newest submitted frame.
+
+    submit() copies into a double buffer and returns; a worker thread hands
+    each frame to encode_frame(). A worker that falls behind loses the older
+    frames (counted as `dropped`) rather than stalling capture.
+    """
+    def __init__(self, frame_size, fps, on_chunk):
+        super().__init__(frame_size, fps, on_chunk)
+        self.lock = threading.Lock()
+        self.frame_ready = threading.Event()
+        width, height = frame_size
+        # submit() fills `pending`, the worker thread drains `writing`
+        self.pending = np.empty((height, width, 3), np.uint8)
+        self.writing = np.empty_like(self.pending)
+        self.pending_timestamp = None
+        self.running = False
+        self.thread = None
+        self.counters = {'submitted': 0, 'dropped': 0, 'chunks': 0, 'bytes': 0, 'keyframes': 0}
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name=f'{self.codec}-encoder', daemon=True)
+        self.thread.start()
+
+    def submit(self, frame, timestamp):
+        if not self.running:
+            return
+        with self.lock:
+            if self.pending_timestamp is not None:
+                self.counters['dropped'] += 1
+            if frame.shape[1::-1] == self.frame_size:
+                np.copyto(self.pending, frame)
+            else:
+                cv2.resize(frame, self.frame_size, dst=self.pending)
+            self.pending_timestamp = timestamp
+            self.counters['submitted'] += 1
+        self.frame_ready.set()
+
+    def run(self):
+        # After stop() the frame still pending is encoded before the thread exits
+        while True:
+            self.frame_ready.wait(0.5)
+            with self.lock:
+                self.frame_ready.clear()
+                if self.pending_timestamp is None:
+                    if not self.running:
+                        break
+                    continue
+                self.pending, self.writing = self.writing, self.pending
+                timestamp, self.pending_timestamp = self.pending_timestamp, None
+            if not self.encode_frame(self.writing, timestamp):
+                break
+        self.running = False
+
+    def encode_frame(self, frame, timestamp):
+        """Worker thread; returns False to stop the encoder"""
+        raise NotImplementedError
+
+    def stop(self):
+        self.running = False
+        self.frame_ready.set()
+
+    def emit(self, payload, timestamp, keyframe):
+        self.counters['chunks'] += 1
+        self.counters['bytes'] += len(payload)
+        self.counters['keyframes'] += keyframe
+        self.on_chunk(payload, timestamp, keyframe)
+
+
+class H264Encoder(LatestFrameEncoder):
+    """H.264 through a local ffmpeg subprocess, emitted as Annex-B access units.
+
+    Raw BGR frames are piped to ffmpeg's stdin from the worker thread, so a
+    slow encoder drops input frames instead of stalling capture. ffmpeg muxes
+    to FLV on stdout: pipe reads can merge or split packets, but FLV tags
+    carry their own size, timestamp and keyframe flag, so the reader thread
+    gets exactly one encoded frame per tag and maps it back to its capture
+    timestamp. Each frame is converted back to
+    Annex-B, with SPS/PPS put in front of every keyframe so late joiners can
+    start decoding. `video_codec` can be 'libx264' or a hardware encoder such
+    as the Pi's 'h264_v4l2m2m'.
+    """
+    codec = 'h264'
+
+    def __init__(self, frame_size, fps, on_chunk, ffmpeg=None, video_codec='libx264',
+                 bitrate='1M'):
+        super().__init__(frame_size, fps, on_chunk)
+        self.ffmpeg = ffmpeg or shutil.which('ffmpeg')
+        self.video_codec = video_codec
+        self.bitrate = bitrate
+        self.process = None
+        self.stdin = None
+        # (input frame index, capture timestamp) for frames handed to ffmpeg
+        self.timestamps = deque(maxlen=4 * fps)
+        self.frames_written = 0
+
+    def command(self):
+        width, height = self.frame_size
+        cmd = [self.ffmpeg, '-hide_banner', '-loglevel', 'error',
+               '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f'{width}x{height}',
+               '-r', str(self.fps), '-i', '-', '-an', '-c:v', self.video_codec]
+        if self.video_codec == 'libx264':
+            cmd += ['-preset', 'ultrafast', '-tune', 'zerolatency']
+        # One-second GOP so late joiners can start decoding within a second;
+        # no B-frames for latency
+        cmd += ['-b:v', self.bitrate, '-g', str(self.fps), '-bf', '0',
+                '-pix_fmt', 'yuv420p', '-flush_packets', '1', '-f', 'flv', '-']
+        return cmd
+
+    def start(self):
+        if self.ffmpeg is None:
+            raise RuntimeError("ffmpeg not found; H.264 streaming is unavailable")
+        self.process = subprocess.Popen(
+            self.command(), stdin=subprocess.PIPE, stdout=subprocess.PIPE, bufsize=0)
+        self.stdin = self.process.stdin
+        super().start()
+        threading.Thread(target=self.read_loop, args=(self.process.stdout,),
+                         name='h264-reader', daemon=True).start()
+        log.info("encoder_started", "H.264 encoder started", video_codec=self.video_codec,
+                 size=f"{self.frame_size[0]}x{self.frame_size[1]}", fps=self.fps)
+
+    def encode_frame(self, frame, timestamp):
+        self.timestamps.append((self.frames_written, timestamp))
+        self.frames_written += 1
+        try:
+            self.stdin.write(memoryview(frame))
+        except (BrokenPipeError, ValueError, OSError, AttributeError):
+            return False
+        return True
+
+    def capture_time(self, index):
+        """Capture timestamp of input frame `index`; frames the encoder skipped are dropped"""
+        while self.timestamps and self.timestamps[0][0] < index:
+            self.timestamps.popleft()
+        if self.timestamps and self.timestamps[0][0] == index:
+            return self.timestamps.popleft()[1]
+        return time.time()
+
+    def read_loop(self, stdout):
+        parameter_sets, length_size = b'', 4
+        if read_exact(stdout, FLV_HEADER_SIZE) is None:
+            self.running = False
+            return
+        while True:
+            tag = read_exact(stdout, FLV_TAG.size)
+            if tag is None:
+                break
+            type_size, timestamp_ms = FLV_TAG.unpack(tag)
+            tag_type, size = type_size >> 24, type_size & 0xFFFFFF
+            # Tag body, then the 4-byte size of the tag just read
+            body = read_exact(stdout, size + 4)
+            if body is None:
+                break
+            if tag_type != FLV_TAG_VIDEO or len(body) < 9:
+                continue
+            body = body[:-4]
+            frame_type, packet_type = body[0] >> 4, body[1]
+            if packet_type == AVC_SEQUENCE_HEADER:
+                parameter_sets, length_size = avcc_parameter_sets(body[5:])
+                continue
+            if packet_type != AVC_NALU:
+                continue
+            payload, nal_types = avcc_to_annexb(body[5:], length_size)
+            keyframe = frame_type == FLV_KEYFRAME
+            if keyframe and NAL_SPS not in nal_types:
+                payload = parameter_sets + payload
+            # FLV timestamps are milliseconds of input time, i.e. frame index / fps
+            milliseconds = ((timestamp_ms & 0xFF) << 24) | (timestamp_ms >> 8)
+            timestamp = self.capture_time(round(milliseconds * self.fps / 1000))
+            self.emit(payload, timestamp, keyframe)
+        self.running = False
+
+    def stop(self):
+        """Returns at once; the last frame is written and ffmpeg reaped on a background thread"""
+        super().stop()
+        process, self.process = self.process, None
+        if process is not None:
+            threading.Thread(target=self.reap, args=(process,), name='h264-reaper',
+                             daemon=True).start()
+
+    def reap(self, process):
+        if self.thread is not None:
+            self.thread.join(timeout=2)
+        try:
+            process.stdin.close()
+        except OSError:
+            pass
+        try:
+            process.wait(timeout=2)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+        log.info("encoder_stopped", "H.264 encoder stopped")
+
+    def get_stats(self):
+        return dict(self.counters, video_codec=self.video_codec, bitrate=self.bitrate)
+
+
+ENCODERS = {
+    'jpeg': JpegEncoder,
+    'h264': H264Encoder,
+}
+
+CODEC_IDS = {codec: index for index, codec in enumerate(ENCODERS)}
+
+
+def main():
+    """Encode a few seconds of synthetic frames: python encoders.py [codec] [seconds]"""
+    from frame_sources import SyntheticSource
+
+    codec = sys.argv[1] if len(sys.argv) > 1 else 'h264'
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 3.0
+    frame_size, fps = (480, 360), 30
+    source = SyntheticSource('gradient', *frame_size, fps=fps)
+    chunks = []
+
+    if codec == 'jpeg':
+        encoder = JpegEncoder(BufferPool())
+    else:
+        encoder = ENCODERS[codec](frame_size, fps,
+                                  lambda payload, timestamp, keyframe: chunks.append(payload))
+        encoder.start()
+
+    start = time.monotonic()
+    frames = 0
+    while time.monotonic() - start < seconds:
+        _, frame = source.read()
+        if encoder.streaming:
+            encoder.submit(frame, time.time())
+        else:
+            chunks.append(encoder.encode(frame, [cv2.IMWRITE_JPEG_QUALITY, 65], frame_size))
+        frames += 1
+
+    if encoder.streaming:
+        time.sleep(0.5)
+        encoder.stop()
+        print(encoder.get_stats())
+    total = sum(len(chunk) for chunk in chunks)
+    print(f"{codec}: {frames} frames in, {len(chunks)} chunks out, "
+          f"{total / max(1, frames):.0f} bytes/frame, {total * 8 / seconds / 1000:.0f} kbit/s")
+
+
+if __name__ == '__main__':
+    main()
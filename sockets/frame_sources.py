@@ -0,0 +1,164 @@
+"""Frame sources for VideoStream.
+
+Every source looks like a cv2.VideoCapture (isOpened/read/grab/set/get/
+release), so VideoStream doesn't care whether frames come from the camera,
+a generated test pattern or a recorded video. Use open_frame_source() with:
+
+* an int or 'camera' / 'camera:N'  - a V4L2 camera, as before
+* 'synthetic' or 'synthetic:<pattern>' - generated NumPy frames, no camera
+* a file path                      - replays a recorded video in a loop
+"""
+import os
+import time
+
+import cv2
+import numpy as np
+
+SYNTHETIC_PATTERNS = ('gradient', 'noise', 'static')
+
+
+class PacedSource:
+    """Blocks read()/grab() like a real camera would, at `fps` (0 = unpaced)"""
+    def __init__(self, fps):
+        self.fps = fps
+        self.next_frame = time.monotonic()
+
+    def wait_for_frame(self):
+        if not self.fps:
+            return
+        now = time.monotonic()
+        self.next_frame = max(self.next_frame + 1 / self.fps, now)
+        if self.next_frame > now:
+            time.sleep(self.next_frame - now)
+
+
+class SyntheticSource(PacedSource):
+    """Generated test frames.
+
+    'gradient' scrolls a colour gradient with a moving box (typical motion),
+    'noise' is random pixels (worst case for JPEG) and 'static' never changes.
+    """
+    def __init__(self, pattern='gradient', width=480, height=360, fps=60):
+        if pattern not in SYNTHETIC_PATTERNS:
+            raise ValueError(f"Unknown synthetic pattern: {pattern}")
+        super().__init__(fps)
+        self.pattern = pattern
+        self.opened = True
+        self.frame_index = 0
+        self.rng = np.random.default_rng(0)
+        self.resize(width, height)
+
+    def resize(self, width, height):
+        self.width, self.height = int(width), int(height)
+        self.frame = np.zeros((self.height, self.width, 3), np.uint8)
+        x = np.arange(self.width, dtype=np.uint16)
+        y = np.arange(self.height, dtype=np.uint16)
+        self.base = ((x[None, :] + y[:, None]) & 0xFF).astype(np.uint8)
+        self.render()
+
+    def render(self):
+        if self.pattern == 'noise':
+            self.frame[...] = self.rng.integers(0, 256, self.frame.shape, dtype=np.uint8)
+            return
+        if self.pattern == 'static' and self.frame_index > 0:
+            return
+        shift = (self.frame_index * 4) % self.width
+        np.copyto(self.frame[:, :, 0], np.roll(self.base, shift, axis=1))
+        self.frame[:, :, 1] = self.frame[:, :, 0] // 2
+        self.frame[:, :, 2] = 255 - self.frame[:, :, 0]
+        box = self.height // 4
+        left = (self.frame_index * 6) % max(1, self.width - box)
+        top = self.height // 2 - box // 2
+        self.frame[top:top + box, left:left + box] = 255
+
+    def isOpened(self):
+        return self.opened
+
+    def grab(self):
+        self.wait_for_frame()
+        self.frame_index += 1
+        self.render()
+        return self.opened
+
+    def retrieve(self, image=None):
+        if image is None or image.shape != self.frame.shape:
+            return self.opened, self.frame.copy()
+        np.copyto(image, self.frame)
+        return self.opened, image
+
+    def read(self, image=None):
+        if not self.grab():
+            return False, None
+        return self.retrieve(image)
+
+    def set(self, prop, value):
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            self.resize(value, self.height)
+        elif prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            self.resize(self.width, value)
+        elif prop == cv2.CAP_PROP_FPS:
+            self.fps = value
+        return True
+
+    def get(self, prop):
+        return {
+            cv2.CAP_PROP_FRAME_WIDTH: self.width,
+            cv2.CAP_PROP_FRAME_HEIGHT: self.height,
+            cv2.CAP_PROP_FPS: self.fps,
+        }.get(prop, 0)
+
+    def release(self):
+        self.opened = False
+
+
+class FileSource(PacedSource):
+    """Replays a recorded video at its own frame rate, looping at the end"""
+    def __init__(self, path, loop=True):
+        self.cap = cv2.VideoCapture(path)
+        super().__init__(self.cap.get(cv2.CAP_PROP_FPS) or 30)
+        self.path = path
+        self.loop = loop
+
+    def isOpened(self):
+        return self.cap.isOpened()
+
+    def grab(self):
+        self.wait_for_frame()
+        if self.cap.grab():
+            return True
+        if not self.loop:
+            return False
+        self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+        return self.cap.grab()
+
+    def retrieve(self, image=None):
+        return self.cap.retrieve(image)
+
+    def read(self, image=None):
+        if not self.grab():
+            return False, None
+        return self.retrieve(image)
+
+    def set(self, prop, value):
+        # Size and buffering belong to the recording; only pacing can change
+        if prop == cv2.CAP_PROP_FPS:
+            self.fps = min(value, self.cap.get(cv2.CAP_PROP_FPS) or value)
+        return True
+
+    def get(self, prop):
+        return self.cap.get(prop)
+
+    def release(self):
+        self.cap.release()
+
+
+def open_frame_source(source=0):
+    if isinstance(source, int):
+        return cv2.VideoCapture(source)
+    if source == 'camera' or source.startswith('camera:'):
+        return cv2.VideoCapture(int(source.partition(':')[2] or 0))
+    if source == 'synthetic' or source.startswith('synthetic:'):
+        return SyntheticSource(source.partition(':')[2] or 'gradient')
+    if os.path.exists(source):
+        return FileSource(source)
+    raise ValueError(f"Unknown frame source: {source}")
@@ -1,6 +1,26 @@
 import React, { useState, useEffect, useCallback, useRef } from 'react';
 import { ArrowUp, ArrowDown, ArrowLeft, ArrowRight, Power, Clock } from 'lucide-react';
 
+// How long a movement command holds on the server without a lease_renew
+const MOVE_LEASE_MS = 300;
+
+// Binary control protocol (see CONTROL_PACKET / CONTROL_ACK in server.py)
+const MOVEMENT_COMMANDS = ['stop', 'forward', 'backward', 'left', 'right'];
+const CONTROL_OP_MOVE = 1;
+const CONTROL_OP_RENEW = 2;
+const CONTROL_ACK_KIND = 0x81;
+const ACK_LEASE_EXPIRED = 1;
+
+const packControl = (op, command, power, leaseMs, sequence) => {
+  const view = new DataView(new ArrayBuffer(10));
+  view.setUint8(0, op);
+  view.setUint8(1, MOVEMENT_COMMANDS.indexOf(command));
+  view.setUint8(2, power);
+  view.setUint16(4, leaseMs, true);
+  view.setUint32(6, sequence, true);
+  return view.buffer;
+};
+
 const App = () => {
   const [ws, setWs] = useState(null);
   const [connected, setConnected] = useState(false);
@@ -12,7 +32,15 @@ const App = () => {
   
   // Refs for continuous movement
   const moveIntervalRef = useRef(null);
+  // Set when the server reports our movement lease ran out
+  const leaseExpiredRef = useRef(false);
   const activeCommandRef = useRef(null);
+  // Sequence of the frame currently being decoded, acked once it is displayed
+  const pendingFrameRef = useRef(null);
+  const socketRef = useRef(null);
+  // Control packet sequence, and when each unanswered packet was sent
+  const controlSequenceRef = useRef(0);
+  const controlSentRef = useRef(new Map());
 
   // Connect/reconnect function
   const connectWebSocket = useCallback(() => {
@@ -22,13 +50,19 @@ const App = () => {
       }
 
       const socket = new WebSocket('ws://127.0.0.1:5000/ws');
+      socket.binaryType = 'arraybuffer';
 
       socket.onopen = () => {
         console.log('Connected to server');
         setConnected(true);
+        // Struct-packed commands, acked only when the answer changes
+        socket.send(JSON.stringify({
+          type: 'control_format',
+          data: { format: 'binary', acks: 'on_change' }
+        }));
         socket.send(JSON.stringify({
           type: 'start_video',
-          data: {}
+          data: { format: 'binary' }
         }));
       };
 
@@ -45,6 +79,55 @@ const App = () => {
       };
 
       socket.onmessage = (event) => {
+        if (event.data instanceof ArrayBuffer &&
+            new DataView(event.data).getUint8(0) === CONTROL_ACK_KIND) {
+          const view = new DataView(event.data);
+          const status = view.getUint8(1);
+          const sequence = view.getUint32(4, true);
+          if (status === ACK_LEASE_EXPIRED) {
+            leaseExpiredRef.current = true;
+            return;
+          }
+          const sentAt = controlSentRef.current.get(sequence);
+          for (const pending of controlSentRef.current.keys()) {
+            if (pending <= sequence) {
+              controlSentRef.current.delete(pending);
+            }
+          }
+          setCommandHistory(prev => [{
+            command: MOVEMENT_COMMANDS[view.getUint8(2)],
+            power: view.getUint8(3),
+            latency: sentAt ? (performance.now() - sentAt).toFixed(1) : '-',
+            timestamp: new Date().toLocaleTimeString()
+          }, ...prev].slice(0, 5));
+          return;
+        }
+
+        if (event.data instanceof ArrayBuffer) {
+          // Binary video frame: fixed header (see VIDEO_HEADER in server.py) + JPEG
+          const view = new DataView(event.data);
+          const headerLength = view.getUint16(2, true);
+          const sequence = view.getUint32(4, true);
+          const timestamp = view.getFloat64(8, true);
+          const fps = view.getFloat32(16, true);
+          const url = URL.createObjectURL(
+            new Blob([new Uint8Array(event.data, headerLength)], { type: 'image/jpeg' })
+          );
+          pendingFrameRef.current = sequence;
+          setVideoStream(prev => {
+            if (prev && prev.startsWith('blob:')) {
+              URL.revokeObjectURL(prev);
+            }
+            return url;
+          });
+          const latency = (Date.now() - timestamp * 1000).toFixed(1);
+          setMetrics(prev => ({
+            fps: fps ? fps.toFixed(1) : prev.fps,
+            latency
+          }));
+          return;
+        }
+
         const message = JSON.parse(event.data);
         
         if (message.type === 'connection_status') {
@@ -57,6 +140,8 @@ const App = () => {
             fps: message.data.fps || prev.fps,
             latency
           }));
+        } else if (message.type === 'lease_expired') {
+          leaseExpiredRef.current = true;
         } else if (message.type === 'command_response') {
           const latency = (Date.now() - message.data.timestamp * 1000).toFixed(1);
           setCommandHistory(prev => [{
@@ -68,6 +153,7 @@ const App = () => {
         }
       };
 
+      socketRef.current = socket;
       setWs(socket);
     } catch (error) {
       console.error('Connection error:', error);
@@ -90,6 +176,22 @@ const App = () => {
     };
   }, [connectWebSocket]);
 
+  // Report display time for every 10th frame so the server can measure
+  // capture-to-display latency (see /metrics)
+  const handleFrameDisplayed = () => {
+    const sequence = pendingFrameRef.current;
+    const socket = socketRef.current;
+    if (sequence === null || sequence % 10 !== 0) {
+      return;
+    }
+    if (socket && socket.readyState === WebSocket.OPEN) {
+      socket.send(JSON.stringify({
+        type: 'frame_ack',
+        data: { sequence, displayed_at: Date.now() / 1000 }
+      }));
+    }
+  };
+
   // Handle power changes
   const handlePowerChange = (newPower) => {
     setPower(newPower);
@@ -104,13 +206,23 @@ const App = () => {
   // Movement command handler
   const sendCommand = useCallback((command) => {
     if (ws && ws.readyState === WebSocket.OPEN) {
-      ws.send(JSON.stringify({
-        type: 'movement_command',
-        data: { command, power }
-      }));
+      const sequence = ++controlSequenceRef.current;
+      // Acks only come back on change, so keep this bounded
+      if (controlSentRef.current.size > 100) {
+        controlSentRef.current.clear();
+      }
+      controlSentRef.current.set(sequence, performance.now());
+      ws.send(packControl(CONTROL_OP_MOVE, command, power, MOVE_LEASE_MS, sequence));
     }
   }, [ws, power]);
 
+  // Keep the current movement's lease alive without resending the command
+  const renewLease = useCallback(() => {
+    if (ws && ws.readyState === WebSocket.OPEN) {
+      ws.send(packControl(CONTROL_OP_RENEW, 'stop', 0, 0, ++controlSequenceRef.current));
+    }
+  }, [ws]);
+
   // Start continuous movement
   const startContinuousMove = useCallback((command) => {
     if (moveIntervalRef.current) {
@@ -118,15 +230,23 @@ const App = () => {
     }
     
     activeCommandRef.current = command;
+    leaseExpiredRef.current = false;
     sendCommand(command); // Send initial command
     
-    // Send command every 100ms while key is held
+    // Renew the lease every 100ms while key is held; the server stops the
+    // motors by itself if renewals stop arriving
     moveIntervalRef.current = setInterval(() => {
-      if (activeCommandRef.current === command) {
+      if (activeCommandRef.current !== command) {
+        return;
+      }
+      if (leaseExpiredRef.current) {
+        leaseExpiredRef.current = false;
         sendCommand(command);
+      } else {
+        renewLease();
       }
     }, 100);
-  }, [sendCommand]);
+  }, [sendCommand, renewLease]);
 
   // Stop continuous movement
   const stopContinuousMove = useCallback((command) => {
@@ -134,8 +254,9 @@ const App = () => {
       clearInterval(moveIntervalRef.current);
       moveIntervalRef.current = null;
       activeCommandRef.current = null;
+      sendCommand('stop');
     }
-  }, []);
+  }, [sendCommand]);
 
   // Keyboard controls
   useEffect(() => {
@@ -203,6 +324,7 @@ const App = () => {
               <img 
                 src={videoStream} 
                 alt="Robot camera feed" 
+                onLoad={handleFrameDisplayed}
                 className="w-full h-full object-contain"
               />
             ) : (
@@ -1,125 +1,1306 @@
 import tornado.ioloop
+import tornado.iostream
 import tornado.web
 import tornado.websocket
+import argparse
+import bisect
 import json
 import time
 import asyncio
 import cv2
 import numpy as np
 import base64
+import struct
+import gc
+import os
+import queue
+import socket
+import sys
+import threading
+from collections import deque
 from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from threading import Lock
 
-class VideoStream:
+from encoders import BufferPool, CODEC_IDS, ENCODERS, JpegEncoder
+from frame_sources import open_frame_source
+from video_recorder import VideoRecorder
+
+# Shared modules (rov_log.py, gpio_pins.py, ...) live at the repo root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import rov_log
+from flight_recorder import (FlightRecorder, KIND_COMMAND, KIND_FRAME, KIND_MESSAGE)
+
+log = rov_log.get_logger('SERVER')
+
+# Binary video frames are a fixed little-endian header followed by the payload:
+# version (u8), pad, header length (u16), sequence (u32), capture timestamp
+# (f64, unix seconds), fps (f32), then the encode settings used for the frame:
+# JPEG quality (u8), quality level (u8), width (u16), height (u16), codec
+# (u8, see encoders.CODEC_IDS) and flags (u8, bit 0 = keyframe).
+# JPEG payloads are whole images; H.264 payloads are Annex-B access units,
+# one frame each.
+# Clients should skip `header length` bytes to find the payload so the header
+# can grow without breaking them.
+VIDEO_HEADER = struct.Struct('<BxHIdfBBHHBB')
+VIDEO_HEADER_VERSION = 3
+FRAME_FLAG_KEYFRAME = 0x01
+
+VIDEO_FORMATS = ('json', 'binary')
+
+# (JPEG quality, frame size, fps) from best to most degraded
+QUALITY_LEVELS = [
+    (75, (480, 360), 60),
+    (65, (480, 360), 60),
+    (55, (480, 360), 30),
+    (45, (320, 240), 30),
+    (35, (320, 240), 15),
+    (25, (240, 180), 10),
+]
+DEFAULT_QUALITY_LEVEL = 1
+# Recordings are made at the best level's quality and frame rate, at capture size
+RECORDING_QUALITY, _, RECORDING_FPS = QUALITY_LEVELS[0]
+
+# Published frames per sys.getallocatedblocks() sample (see sample_allocations)
+ALLOCATION_WINDOW = 300
+
+
+def pack_video_frame(frame_data):
+    width, height = frame_data['size']
+    header = VIDEO_HEADER.pack(VIDEO_HEADER_VERSION, VIDEO_HEADER.size,
+                               frame_data['sequence'], frame_data['timestamp'],
+                               frame_data['fps'], frame_data['quality'],
+                               frame_data['level'], width, height,
+                               CODEC_IDS[frame_data['codec']],
+                               FRAME_FLAG_KEYFRAME if frame_data['keyframe'] else 0)
+    return b''.join((header, frame_data['frame']))
+
+
+def frame_to_json(frame_data):
+    data = {
+        'frame': base64.b64encode(frame_data['frame']).decode('ascii'),
+        'timestamp': frame_data['timestamp'],
+        'sequence': frame_data['sequence'],
+        'quality': frame_data['quality'],
+        'level': frame_data['level'],
+        'width': frame_data['size'][0],
+        'height': frame_data['size'][1],
+        'fps': frame_data['fps'],
+        'encoded_at': frame_data['encoded_at'],
+        'published_at': frame_data['published_at'],
+    }
+    return json.dumps({'type': 'video_frame', 'data': data})
+
+
+# Binary control packets (client -> server), enabled with a control_format
+# message: op (u8), command (u8, index into MOVEMENT_COMMANDS), power (u8),
+# pad, lease in ms (u16, 0 = server default) and sequence (u32).
+CONTROL_PACKET = struct.Struct('<BBBxHI')
+CONTROL_OP_MOVE = 1
+CONTROL_OP_RENEW = 2
+MOVEMENT_COMMANDS = ('stop', 'forward', 'backward', 'left', 'right', 'up', 'down')
+# Command id acked for an axis-vector (movement_vector) command
+CONTROL_COMMAND_VECTOR = 0xFF
+
+# Binary control acks (server -> client): kind (u8, CONTROL_ACK_KIND, which
+# can't clash with a video frame's version byte), status (u8), command (u8),
+# power (u8) and the sequence (u32) of the packet being answered.
+CONTROL_ACK = struct.Struct('<BBBBI')
+CONTROL_ACK_KIND = 0x81
+ACK_ACCEPTED = 0
+ACK_LEASE_EXPIRED = 1
+# Invalid movement; the motors were left as they were
+ACK_REJECTED = 2
+
+CONTROL_FORMATS = ('json', 'binary')
+
+# 'all' answers every command; 'on_change' only when the answer differs from
+# the last one sent, so a held key costs no server writes at all
+ACK_MODES = ('all', 'on_change')
+
+# Flight recorder codes for incoming messages; binary control packets are
+# 'control_packet' and anything not listed here is recorded as 0xFF
+RECORDED_MESSAGES = ('control_packet', 'movement_command', 'lease_renew', 'control_format',
+                     'power_update', 'start_video', 'frame_ack', 'get_video_stats',
+                     'stop_video', 'movement_vector', 'get_control_stats')
+
+
+def command_code(command):
+    """Wire/recorder code for a movement command; vectors share one code"""
+    if command in MOVEMENT_COMMANDS:
+        return MOVEMENT_COMMANDS.index(command)
+    return CONTROL_COMMAND_VECTOR
+
+
+STREAM_LATENCY_STAGES = ('capture_to_encoded', 'encoded_to_published')
+CLIENT_LATENCY_STAGES = ('published_to_written', 'capture_to_written',
+                         'capture_to_ack', 'capture_to_display')
+
+
+class LatencyHistogram:
+    """Fixed-bucket latency histogram (seconds), cheap enough to record every frame"""
+    BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0)
+
+    def __init__(self, buckets=None):
+        self.buckets = buckets or self.BUCKETS
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def record(self, seconds):
+        seconds = max(0.0, seconds)
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket holding the given fraction of samples"""
+        if not self.count:
+            return 0.0
+        target = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return float('inf')
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'mean_ms': round(1000 * self.sum / self.count, 2) if self.count else 0.0,
+            'p50_ms': self.percentile(0.5) * 1000,
+            'p99_ms': self.percentile(0.99) * 1000,
+        }
+
+    def prometheus(self, name, labels):
+        label_text = ','.join(f'{key}="{value}"' for key, value in labels.items())
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append(f'{name}_bucket{{{label_text},le="{le}"}} {cumulative}')
+        lines.append(f'{name}_sum{{{label_text}}} {self.sum}')
+        lines.append(f'{name}_count{{{label_text}}} {self.count}')
+        return lines
+
+
+class ClientVideoMetrics:
+    """Per-client delivery counters and stage histograms.
+
+    Clients may ack frames ({'type': 'frame_ack', 'data': {'sequence': n,
+    'displayed_at': unix seconds}}). capture_to_ack uses only the server clock
+    and so includes the ack's trip back; capture_to_display uses the client's
+    displayed_at and is only as good as the two clocks' sync.
+    """
+    def __init__(self):
+        self.latency = {stage: LatencyHistogram() for stage in CLIENT_LATENCY_STAGES}
+        self.frames = 0
+        self.bytes = 0
+        self.acks = 0
+        self.dropped = 0
+        # Frames not sent to this client because the scene was static
+        self.static_skipped = 0
+        self.sent = deque(maxlen=256)  # (sequence, capture timestamp) awaiting ack
+
+    def frame_written(self, frame_data, size):
+        written_at = time.time()
+        self.frames += 1
+        self.bytes += size
+        self.latency['published_to_written'].record(written_at - frame_data['published_at'])
+        self.latency['capture_to_written'].record(written_at - frame_data['timestamp'])
+        self.sent.append((frame_data['sequence'], frame_data['timestamp']))
+
+    def frame_acked(self, sequence, displayed_at=None):
+        acked_at = time.time()
+        for sent_sequence, timestamp in self.sent:
+            if sent_sequence == sequence:
+                self.acks += 1
+                self.latency['capture_to_ack'].record(acked_at - timestamp)
+                if displayed_at is not None:
+                    self.latency['capture_to_display'].record(displayed_at - timestamp)
+                return True
+        return False
+
+    def to_dict(self):
+        return {
+            'frames': self.frames,
+            'bytes': self.bytes,
+            'dropped': self.dropped,
+            'static_skipped': self.static_skipped,
+            'acks': self.acks,
+            'latency': {stage: histogram.to_dict() for stage, histogram in self.latency.items()},
+        }
+
+
+MJPEG_BOUNDARY = 'frame'
+
+
+def mjpeg_part(frame_data):
+    header = (f"--{MJPEG_BOUNDARY}\r\n"
+              "Content-Type: image/jpeg\r\n"
+              f"Content-Length: {len(frame_data['frame'])}\r\n"
+              f"X-Timestamp: {frame_data['timestamp']:.6f}\r\n\r\n")
+    return b''.join((header.encode('ascii'), frame_data['frame'], b'\r\n'))
+
+
+class FrameSubscriber:
+    """A single viewer's latest-frame slot.
+
+    Publishing overwrites whatever the viewer has not picked up yet, so a slow
+    client only ever sees the newest frame and never holds up anyone else.
+    """
+    def __init__(self):
+        self.latest = None
+        self.event = asyncio.Event()
+        self.closed = False
+        self.delivered = 0
+        self.dropped = 0
+
+    def publish(self, frame_data):
+        if self.latest is not None:
+            self.dropped += 1
+        self.latest = frame_data
+        self.event.set()
+
+    def close(self):
+        self.closed = True
+        self.event.set()
+
+    def resync(self):
+        """Called when a delivered frame was dropped downstream"""
+        pass
+
+    async def get(self):
+        """Wait for the next frame; returns None once the subscription is closed"""
+        while self.latest is None and not self.closed:
+            self.event.clear()
+            await self.event.wait()
+        if self.closed:
+            return None
+        frame_data, self.latest = self.latest, None
+        self.delivered += 1
+        return frame_data
+
+
+class ChunkSubscriber(FrameSubscriber):
+    """Subscriber for inter-frame codecs, where chunks can't be skipped freely.
+
+    Chunks queue up to max_backlog; past that the backlog is thrown away and
+    the subscriber waits for the next keyframe before resuming, which is also
+    where new subscribers start.
+    """
+    def __init__(self, max_backlog=30):
+        super().__init__()
+        self.backlog = deque()
+        self.max_backlog = max_backlog
+        self.waiting_for_keyframe = True
+
+    def publish(self, frame_data):
+        if self.waiting_for_keyframe:
+            if not frame_data['keyframe']:
+                self.dropped += 1
+                return
+            self.waiting_for_keyframe = False
+        self.backlog.append(frame_data)
+        if len(self.backlog) > self.max_backlog:
+            self.dropped += len(self.backlog)
+            self.backlog.clear()
+            self.waiting_for_keyframe = True
+            return
+        self.event.set()
+
+    def resync(self):
+        # A chunk went missing after delivery; the decoder needs a keyframe
+        self.dropped += len(self.backlog)
+        self.backlog.clear()
+        self.waiting_for_keyframe = True
+
+    async def get(self):
+        while not self.backlog and not self.closed:
+            self.event.clear()
+            await self.event.wait()
+        if self.closed:
+            return None
+        self.delivered += 1
+        return self.backlog.popleft()
+
+
+class FrameHub:
+    """Fans every encoded frame out to all subscribed clients"""
     def __init__(self):
+        self.subscribers = set()
+
+    def subscribe(self, subscriber_class=FrameSubscriber):
+        subscriber = subscriber_class()
+        self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        self.subscribers.discard(subscriber)
+        subscriber.close()
+
+    def publish(self, frame_data):
+        for subscriber in self.subscribers:
+            subscriber.publish(frame_data)
+
+    def close(self):
+        for subscriber in self.subscribers:
+            subscriber.close()
+        self.subscribers.clear()
+
+
+OUTBOUND_CLASSES = ('control', 'telemetry', 'video')
+
+
+class OutboundScheduler:
+    """Per-connection send queues with priorities control > telemetry > video.
+
+    Everything a websocket handler sends goes through send(), which never
+    waits on the socket. A single writer task hands the highest-priority
+    message to the websocket and waits for it to flush before taking the
+    next, so a control ack queues behind at most the one message already on
+    the wire, never behind a backlog of frames.
+
+    Video is the only class that is dropped. A frame still queued when the
+    next one arrives means the socket is congested: independent (JPEG) frames
+    replace the queued one, streaming chunks past max_chunks throw the video
+    queue away so the subscriber can resync on a keyframe. Callbacks get
+    (sent, queued_at) once a message is flushed or dropped.
+
+    `backlog_bytes` is the size of everything queued plus the message being
+    written; with the kernel's share kept small (limit_kernel_backlog) that
+    is the connection's whole send backlog.
+    """
+    def __init__(self, handler, max_video=1, max_chunks=30, kernel_backlog=16 * 1024):
+        self.handler = handler
+        self.limit_kernel_backlog(kernel_backlog)
+        self.max_video = max_video
+        self.max_chunks = max_chunks
+        self.queues = {name: deque() for name in OUTBOUND_CLASSES}
+        self.wait = {name: LatencyHistogram() for name in OUTBOUND_CLASSES}
+        self.sent = dict.fromkeys(OUTBOUND_CLASSES, 0)
+        self.max_depth = dict.fromkeys(OUTBOUND_CLASSES, 0)
+        self.dropped_video = 0
+        self.backlog_bytes = 0
+        self.wakeup = asyncio.Event()
+        self.closed = False
+        self.task = asyncio.create_task(self.run())
+
+    def send(self, message, priority='control', binary=False, callback=None,
+             droppable=True):
+        if self.closed:
+            if callback:
+                callback(False, time.monotonic())
+            return
+        queue = self.queues[priority]
+        entry = (message, binary, callback, time.monotonic())
+        if priority == 'video':
+            if droppable and len(queue) >= self.max_video:
+                self.drop(self.unqueue(queue))
+            elif not droppable and len(queue) >= self.max_chunks:
+                while queue:
+                    self.drop(self.unqueue(queue))
+                self.drop(entry)
+                return
+        queue.append(entry)
+        self.backlog_bytes += len(message)
+        self.max_depth[priority] = max(self.max_depth[priority], len(queue))
+        self.wakeup.set()
+
+    def limit_kernel_backlog(self, unsent_bytes):
+        """Keep the backlog in our queues rather than the kernel's.
+
+        Without this the kernel happily buffers megabytes of frames that
+        nothing can reorder; TCP_NOTSENT_LOWAT (Linux) only reports the socket
+        writable once less than `unsent_bytes` are waiting to go out.
+        """
+        stream = getattr(self.handler.ws_connection, 'stream', None)
+        option = getattr(socket, 'TCP_NOTSENT_LOWAT', None)
+        if stream is None or option is None:
+            return
+        try:
+            stream.socket.setsockopt(socket.IPPROTO_TCP, option, unsent_bytes)
+        except OSError:
+            pass
+
+    def unqueue(self, queue):
+        entry = queue.popleft()
+        self.backlog_bytes -= len(entry[0])
+        return entry
+
+    def drop(self, entry):
+        self.dropped_video += 1
+        callback, queued_at = entry[2], entry[3]
+        if callback:
+            callback(False, queued_at)
+
+    def next_message(self):
+        for priority in OUTBOUND_CLASSES:
+            if self.queues[priority]:
+                return priority, self.queues[priority].popleft()
+        return None, None
+
+    async def run(self):
+        while not self.closed:
+            priority, entry = self.next_message()
+            if entry is None:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            message, binary, callback, queued_at = entry
+            try:
+                await self.handler.write_message(message, binary=binary)
+            except (tornado.websocket.WebSocketClosedError, tornado.iostream.StreamClosedError):
+                self.backlog_bytes -= len(message)
+                if callback:
+                    callback(False, queued_at)
+                self.close()
+                break
+            self.backlog_bytes -= len(message)
+            self.sent[priority] += 1
+            self.wait[priority].record(time.monotonic() - queued_at)
+            if callback:
+                callback(True, queued_at)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        for priority in OUTBOUND_CLASSES:
+            queue = self.queues[priority]
+            while queue:
+                callback, queued_at = self.unqueue(queue)[2:]
+                if callback:
+                    callback(False, queued_at)
+        self.wakeup.set()
+
+    def get_stats(self):
+        return {
+            'depth': {name: len(queue) for name, queue in self.queues.items()},
+            'max_depth': dict(self.max_depth),
+            'sent': dict(self.sent),
+            'dropped_video': self.dropped_video,
+            'backlog_bytes': self.backlog_bytes,
+            'wait': {name: histogram.to_dict() for name, histogram in self.wait.items()},
+        }
+
+
+class AdaptiveQualityController:
+    """Steps the shared stream's quality level from per-client send backlog.
+
+    Every client reports its write latency and send backlog after each frame.
+    The backlog is in frames, not bytes: the OutboundScheduler holds at most
+    one frame on the wire plus one queued, so more than one frame already
+    waiting when the next is ready means the connection can't keep up, at
+    any frame size. The stream steps down as soon as any client is congested (at most once per
+    down_cooldown) and only steps back up after all clients have been clear for
+    up_delay seconds, so it doesn't flap around the threshold.
+    """
+    def __init__(self, stream, high_latency=0.15, low_latency=0.05,
+                 high_buffered=1.5, low_buffered=0.5,
+                 down_cooldown=1.0, up_delay=5.0):
+        self.stream = stream
+        self.enabled = True
+        self.high_latency = high_latency
+        self.low_latency = low_latency
+        self.high_buffered = high_buffered
+        self.low_buffered = low_buffered
+        self.down_cooldown = down_cooldown
+        self.up_delay = up_delay
+        self.samples = {}
+        self.last_change = 0.0
+        self.clear_since = None
+        self.level_changes = 0
+
+    def report(self, client, write_latency, buffered):
+        """`buffered`: the client's send backlog when the frame was queued, in frames"""
+        previous = self.samples.get(client)
+        if previous is not None:
+            # Smooth latency so a single slow write doesn't trigger a step
+            write_latency = 0.7 * previous[0] + 0.3 * write_latency
+        self.samples[client] = (write_latency, buffered)
+        if self.enabled:
+            self.evaluate()
+
+    def forget(self, client):
+        self.samples.pop(client, None)
+
+    def evaluate(self):
+        now = time.monotonic()
+        congested = any(latency > self.high_latency or buffered > self.high_buffered
+                        for latency, buffered in self.samples.values())
+        clear = all(latency < self.low_latency and buffered < self.low_buffered
+                    for latency, buffered in self.samples.values())
+        level = self.stream.quality_level
+        
+        if congested:
+            self.clear_since = None
+            if level < len(QUALITY_LEVELS) - 1 and now - self.last_change >= self.down_cooldown:
+                self.change_level(level + 1, now)
+        elif clear:
+            if self.clear_since is None:
+                self.clear_since = now
+            elif level > 0 and now - self.clear_since >= self.up_delay:
+                self.change_level(level - 1, now)
+                self.clear_since = now
+        else:
+            self.clear_since = None
+
+    def change_level(self, level, now):
+        self.stream.set_quality_level(level)
+        self.last_change = now
+        self.level_changes += 1
+
+    def get_stats(self):
+        worst_latency = max((latency for latency, _ in self.samples.values()), default=0.0)
+        worst_buffered = max((buffered for _, buffered in self.samples.values()), default=0.0)
+        return {
+            'adaptive': self.enabled,
+            'level_changes': self.level_changes,
+            'worst_write_latency_ms': round(worst_latency * 1000, 1),
+            'worst_buffered_frames': round(worst_buffered, 2),
+        }
+
+
+class ChangeDetector:
+    """Skips frames while the scene is static (e.g. the ROV holding station).
+
+    Each frame is shrunk to a small grayscale thumbnail (averaging blocks of
+    pixels, so sensor noise mostly cancels) and compared with the
+    thumbnail of the last frame that went out. It counts as changed when more
+    than `min_changed` of the thumbnail moved by over `threshold` gray levels.
+    Unchanged frames are neither encoded nor sent, except for a keepalive
+    every `keepalive` seconds. threshold=0 sends every frame. Only JPEG is
+    gated; streaming encoders (H.264) get every frame.
+    """
+    def __init__(self, threshold=10, min_changed=0.005, keepalive=1.0, size=(64, 48)):
+        self.threshold = threshold
+        self.min_changed = min_changed
+        self.keepalive = keepalive
+        self.size = size
+        # Only the capture thread touches `reference`; reset() just raises a flag
+        self.reference = None
+        self.force_next = False
+        self.last_sent = 0.0
+        self.counters = {'changed': 0, 'keepalives': 0, 'static_skipped': 0}
+
+    def reset(self):
+        """Send the next frame regardless, e.g. for a new viewer (any thread)"""
+        self.force_next = True
+
+    def should_send(self, frame):
+        if not self.threshold:
+            return True
+        now = time.monotonic()
+        # Linear down to twice the thumbnail size, then a 2x2 area average: most
+        # of a full INTER_AREA's noise averaging at a fraction of its cost
+        width, height = self.size
+        small = cv2.resize(frame, (2 * width, 2 * height), interpolation=cv2.INTER_LINEAR)
+        small = cv2.resize(small, self.size, interpolation=cv2.INTER_AREA)
+        thumbnail = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY).astype(np.int16)
+        reference = self.reference
+        if self.force_next:
+            self.force_next = False
+            reference = None
+        if reference is not None:
+            changed = np.count_nonzero(np.abs(thumbnail - reference) > self.threshold)
+            if changed <= self.min_changed * thumbnail.size:
+                if now - self.last_sent < self.keepalive:
+                    self.counters['static_skipped'] += 1
+                    return False
+                self.counters['keepalives'] += 1
+            else:
+                self.counters['changed'] += 1
+        else:
+            self.counters['changed'] += 1
+        self.reference = thumbnail
+        self.last_sent = now
+        return True
+
+    def get_stats(self):
+        return dict(self.counters, change_threshold=self.threshold)
+
+
+class VideoStream:
+    """Two-stage video pipeline.
+
+    The capture thread only grabs frames into a small ring of preallocated
+    buffers; a pool of encoder threads JPEG-encodes them in parallel (OpenCV
+    releases the GIL). Encoded frames are put back in capture order on the
+    event loop, and anything older than latency_budget seconds is dropped.
+    """
+    def __init__(self, source=0, encoder_workers=3, latency_budget=0.1, change_threshold=10,
+                 idle_timeout=60, standby_fps=2):
         self.active = False
+        self.source = source
         self.cap = None
-        self.frame_queue = asyncio.Queue(maxsize=1)
-        self.last_frame_time = 0
-        self.min_frame_interval = 1/60
+        self.hub = FrameHub()
+        self.start_lock = asyncio.Lock()
+        self.loop = None
+        self.capture_thread = None
+        self.target_fps = 60
+        # With no viewers left the camera stays open on standby (grabbing at
+        # standby_fps, nothing encoded) for idle_timeout seconds, so the next
+        # viewer doesn't wait for it to open again; 0 releases it immediately
+        self.idle_timeout = idle_timeout
+        self.standby_fps = standby_fps
+        self.standby = False
+        self.idle_handle = None
+        self.wake = threading.Event()
+        self.capture_size = (480, 360)
         self.executor = ThreadPoolExecutor(max_workers=1)
-        self.encode_params = [cv2.IMWRITE_JPEG_QUALITY, 65]
+        self.encoder_workers = encoder_workers
+        self.encoder_pool = ThreadPoolExecutor(
+            max_workers=encoder_workers, thread_name_prefix='video-encode')
+        self.latency_budget = latency_budget
+        # One buffer per in-flight encode, plus one to capture into
+        self.ring = [np.empty((self.capture_size[1], self.capture_size[0], 3), np.uint8)
+                     for _ in range(encoder_workers + 2)]
+        self.free_slots = queue.SimpleQueue()
+        for slot in range(len(self.ring)):
+            self.free_slots.put(slot)
+        # Captured into for a streaming recording encoder when every ring buffer is busy
+        self.record_buffer = np.empty_like(self.ring[0])
+        self.buffer_pool = BufferPool(max_per_shape=encoder_workers)
+        self.jpeg_encoder = JpegEncoder(self.buffer_pool)
+        # Streaming encoders (e.g. H.264) run only while someone subscribes:
+        # codec -> (encoder, hub). stream_encoders is the capture thread's view.
+        self.streams = {}
+        self.stream_encoders = ()
+        self.reorder = {}
+        self.next_sequence = 0
+        self.change_detector = ChangeDetector(change_threshold)
+        self.quality_level = DEFAULT_QUALITY_LEVEL
+        self.set_quality_level(DEFAULT_QUALITY_LEVEL)
+        self.abr = AdaptiveQualityController(self)
+        # Optional FlightRecorder; gets one record per published frame
+        self.recorder = None
+        # (VideoRecorder, encoder) while recording to disk; encoder is None for
+        # JPEG, which is encoded on the encoder pool alongside the live frame
+        self.recording = None
         self.camera_lock = Lock()
         self.initialization_error = None
+        self.sequence = 0
+        self.counters = {
+            'captured': 0,
+            'encoded': 0,
+            'busy_dropped': 0,
+            'late_dropped': 0,
+            'encode_failed': 0,
+            'published': 0,
+            'serializations': 0,
+            'standby_grabs': 0,
+            'capture_errors': 0,
+        }
+        # Stream-wide stages; per-client delivery stages live on each client
+        self.latency = {stage: LatencyHistogram() for stage in STREAM_LATENCY_STAGES}
+        self.publish_fps = 0.0
+        self.publish_window_start = time.monotonic()
+        self.publish_window_frames = 0
+        # Counted only while the stream is active; stop() removes the callback
+        self.gc_collections = 0
+        # (published count, allocated blocks) at the last sample
+        self.allocation_sample = (0, sys.getallocatedblocks())
+        self.blocks_per_frame = 0.0
+        self.stats = {
+            'capture_fps': 0.0,
+            'capture_thread_cpu': 0.0,
+            'capture_thread_idle': 100.0,
+            'process_cpu': 0.0,
+            'pacing_sleep_ratio': 0.0,
+        }
     
     def initialize_camera(self):
         try:
             with self.camera_lock:
                 if self.cap is None:
-                    self.cap = cv2.VideoCapture(0)
+                    self.cap = open_frame_source(self.source)
                     if not self.cap.isOpened():
-                        raise RuntimeError("Failed to open camera")
+                        raise RuntimeError(f"Failed to open frame source {self.source!r}")
                     
-                    self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, 480)
-                    self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 360)
+                    self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, self.capture_size[0])
+                    self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, self.capture_size[1])
                     self.cap.set(cv2.CAP_PROP_FPS, 60)
                     self.cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
-                    print("[SERVER] Camera initialized successfully")
-                    return True
+                    log.info("camera_ready", "Camera initialized", source=self.source)
+                return True
         except Exception as e:
             self.initialization_error = str(e)
-            print(f"[SERVER] Camera initialization error: {e}")
+            log.error("camera_error", "Camera initialization failed", error=e)
             return False
     
     async def start(self):
-        success = await asyncio.get_event_loop().run_in_executor(
-            self.executor, self.initialize_camera)
-        
-        if success:
-            self.active = True
-            asyncio.create_task(self.capture_frames())
-            print("[SERVER] Video stream started")
-            return True
-        else:
-            print(f"[SERVER] Failed to start video stream: {self.initialization_error}")
-            return False
+        # Every viewer calls start(); only the first one opens the camera
+        async with self.start_lock:
+            if self.active:
+                self.leave_standby()
+                return True
+            
+            success = await asyncio.get_event_loop().run_in_executor(
+                self.executor, self.initialize_camera)
+            
+            if success:
+                self.active = True
+                self.loop = asyncio.get_running_loop()
+                self.reorder.clear()
+                self.capture_thread = threading.Thread(
+                    target=self.capture_loop, name='video-capture', daemon=True)
+                self.capture_thread.start()
+                gc.callbacks.append(self.count_gc)
+                log.info("video_started", "Video stream started")
+                return True
+            else:
+                log.error("video_start_failed", "Failed to start video stream",
+                          error=self.initialization_error)
+                return False
+    
+    def leave_standby(self):
+        if self.idle_handle is not None:
+            self.idle_handle.cancel()
+            self.idle_handle = None
+        if self.standby:
+            self.standby = False
+            self.wake.set()
+            log.info("video_resumed", "Camera back to full rate")
+    
+    def release_if_unwatched(self):
+        """When a viewer leaves: standby once nobody is subscribed, stop after idle_timeout"""
+        if (not self.active or self.standby or self.hub.subscribers or self.streams
+                or self.recording):
+            return
+        if not self.idle_timeout:
+            self.stop()
+            return
+        self.standby = True
+        self.idle_handle = self.loop.call_later(self.idle_timeout, self.stop)
+        log.info("video_standby", "No viewers; camera on standby", idle_timeout=self.idle_timeout)
     
     def stop(self):
         self.active = False
+        if self.idle_handle is not None:
+            self.idle_handle.cancel()
+            self.idle_handle = None
+        self.standby = False
+        self.wake.set()
+        if self.count_gc in gc.callbacks:
+            gc.callbacks.remove(self.count_gc)
+        if self.recording:
+            self.stop_recording()
+        self.hub.close()
+        for codec in list(self.streams):
+            self.stop_stream(codec)
         if self.cap is not None:
             with self.camera_lock:
                 self.cap.release()
                 self.cap = None
-        print("[SERVER] Video stream stopped")
+        log.info("video_stopped", "Video stream stopped")
+    
+    def set_quality_level(self, level):
+        quality, frame_size, fps = QUALITY_LEVELS[level]
+        # Replaced wholesale so encoder threads always see a consistent snapshot
+        self.encode_settings = (level, [cv2.IMWRITE_JPEG_QUALITY, quality], frame_size)
+        self.quality_level = level
+        self.target_fps = fps
+        # Viewers should see the new settings even if the scene is static
+        self.change_detector.reset()
+        if self.active:
+            log.info("quality_level", "Video quality level changed", quality_level=level,
+                     quality=quality, size=f"{frame_size[0]}x{frame_size[1]}", fps=fps)
+    
+    def read_frame(self, buffer=None):
+        """Grab one frame from the camera, into `buffer` when it has the right shape"""
+        with self.camera_lock:
+            if self.cap is None or not self.cap.isOpened():
+                return None
+            ret, frame = self.cap.read(buffer)
+        return frame if ret else None
+    
+    def encode_frame(self, frame, encode_params=None, frame_size=None):
+        if encode_params is None or frame_size is None:
+            _, encode_params, frame_size = self.encode_settings
+        return self.jpeg_encoder.encode(frame, encode_params, frame_size)
     
     def capture_and_encode_frame(self):
-        if self.cap is None or not self.cap.isOpened():
+        frame = self.read_frame()
+        if frame is None:
             return None
+        return self.encode_frame(frame)
+    
+    def encode_slot(self, slot, live=True, recorder=None):
+        """Returns (jpeg, (level, quality, size), encoded_at, recording).
+
+        Each frame carries its own settings; they are None for a frame that is
+        only recorded. `recording` is (recorder, jpeg) when a recorder is given.
+        """
+        level, encode_params, frame_size = self.encode_settings
+        buffer = settings = recording = None
+        try:
+            if live:
+                settings = (level, encode_params[1], frame_size)
+                buffer = self.encode_frame(self.ring[slot], encode_params, frame_size)
+            if recorder is not None:
+                if live and settings[1:] == (RECORDING_QUALITY, self.capture_size):
+                    # ABR at the top level: the live JPEG is already what gets recorded
+                    recorded = buffer
+                else:
+                    recorded = self.encode_frame(
+                        self.ring[slot], [cv2.IMWRITE_JPEG_QUALITY, RECORDING_QUALITY],
+                        self.capture_size)
+                recording = (recorder, recorded)
+        finally:
+            self.free_slots.put(slot)
+        return buffer, settings, time.time(), recording
+    
+    def capture_loop(self):
+        """Capture thread: blocks on the camera and paces to target_fps.
+
+        Frames are read into ring buffers and handed to the encoder pool, so
+        the camera keeps capturing while earlier frames are still encoding.
+        """
+        me = threading.current_thread()
+        sequence = self.next_sequence
+        next_frame = time.monotonic()
+        window_start = next_frame
+        window_frames = 0
+        window_sleep = 0.0
+        cpu_start = time.thread_time()
+        process_start = time.process_time()
+        
+        next_live = next_frame
+        while self.active and self.capture_thread is me:
+            standby = self.standby
+            recorder, record_encoder = self.recording or (None, None)
+            # A recording gets every frame at its own rate; viewers get target_fps of them
+            fps = max(self.target_fps, RECORDING_FPS) if recorder else self.target_fps
+            slot = None
+            if not standby:
+                try:
+                    slot = self.free_slots.get_nowait()
+                except queue.Empty:
+                    pass
             
-        with self.camera_lock:
-            ret, frame = self.cap.read()
-            if ret:
-                frame = cv2.resize(frame, (480, 360))
-                _, buffer = cv2.imencode('.jpg', frame, self.encode_params)
-                return base64.b64encode(buffer).decode('utf-8')
-        return None
-    
-    async def capture_frames(self):
-        while self.active:
-            current_time = time.time()
-            
-            if current_time - self.last_frame_time >= self.min_frame_interval:
-                frame_data = await asyncio.get_event_loop().run_in_executor(
-                    self.executor, self.capture_and_encode_frame)
+            try:
+                if standby:
+                    # Nobody watching: keep the camera streaming, but don't decode or encode
+                    with self.camera_lock:
+                        if self.cap is not None:
+                            self.cap.grab()
+                    self.counters['standby_grabs'] += 1
+                elif slot is None and not record_encoder:
+                    # Every buffer is still encoding; drain the camera and drop the frame
+                    with self.camera_lock:
+                        if self.cap is not None:
+                            self.cap.grab()
+                    self.counters['busy_dropped'] += 1
+                    if recorder:
+                        recorder.drop()
+                else:
+                    # With every buffer still encoding, the frame is read for the
+                    # streaming recording encoder only
+                    frame = self.read_frame(
+                        self.ring[slot] if slot is not None else self.record_buffer)
+                    timestamp = time.time()
+                    if frame is not None:
+                        # cap.read() only reuses the buffer if the shape matched
+                        if slot is not None:
+                            self.ring[slot] = frame
+                        else:
+                            self.record_buffer = frame
+                            self.counters['busy_dropped'] += 1
+                        window_frames += 1
+                        self.counters['captured'] += 1
+                        if record_encoder:
+                            # Ahead of change detection and ABR: the recording keeps everything
+                            record_encoder.submit(frame, timestamp)
+                    now = time.monotonic()
+                    live_due = now >= next_live - 0.5 / fps
+                    if live_due:
+                        next_live = max(next_live + 1 / self.target_fps, now)
+                    live = frame is not None and slot is not None and live_due
+                    if live:
+                        # Every frame: inter-frame codecs make a static scene cheap
+                        # already, and need a steady input for their keyframe interval
+                        for encoder in self.stream_encoders:
+                            encoder.submit(frame, timestamp)
+                    # Same scene as the last JPEG sent: skip encoding and sending it
+                    watched = bool(live and self.hub.subscribers
+                                   and self.change_detector.should_send(frame))
+                    # A JPEG recording is encoded on the pool too, reusing the live
+                    # encode when ABR is at full quality
+                    record = frame is not None and recorder is not None and not record_encoder
                 
-                if frame_data:
-                    try:
-                        while not self.frame_queue.empty():
-                            await self.frame_queue.get()
-                        
-                        await self.frame_queue.put({
-                            'frame': frame_data,
-                            'timestamp': current_time
-                        })
-                        self.last_frame_time = current_time
-                    except:
+                    if slot is None:
                         pass
+                    elif not (watched or record):
+                        # Nobody is watching JPEG right now; don't spend a core encoding
+                        self.free_slots.put(slot)
+                        slot = None
+                    else:
+                        future = self.encoder_pool.submit(
+                            self.encode_slot, slot, watched, recorder if record else None)
+                        slot = None  # the encoder puts it back
+                        future.add_done_callback(partial(
+                            self.frame_encoded, me, sequence, timestamp, time.monotonic()))
+                        sequence = (sequence + 1) & 0xFFFFFFFF
+            
+            except Exception as e:
+                # A bad frame or camera hiccup mustn't end the stream for everyone
+                log.error("capture_error", "Frame capture failed", rate=1, error=e)
+                self.counters['capture_errors'] += 1
+                if slot is not None:
+                    self.free_slots.put(slot)
             
-            await asyncio.sleep(0.001)
+            now = time.monotonic()
+            # Re-read every frame; the quality controller may change target_fps
+            next_frame += 1 / (self.standby_fps if standby else fps)
+            if next_frame > now:
+                # A viewer arriving during standby cuts the wait short
+                if self.wake.wait(next_frame - now):
+                    self.wake.clear()
+                    next_frame = time.monotonic()
+                window_sleep += time.monotonic() - now
+            else:
+                # Running behind (slow camera or encoder); don't try to catch up
+                next_frame = now
+            
+            elapsed = time.monotonic() - window_start
+            if elapsed >= 1.0:
+                cpu_now = time.thread_time()
+                process_now = time.process_time()
+                # CPU percentages are of one core; time blocked in cap.read() is idle
+                thread_cpu = 100 * (cpu_now - cpu_start) / elapsed
+                self.stats = {
+                    'capture_fps': round(window_frames / elapsed, 1),
+                    'capture_thread_cpu': round(thread_cpu, 1),
+                    'capture_thread_idle': round(max(0.0, 100 - thread_cpu), 1),
+                    'process_cpu': round(100 * (process_now - process_start) / elapsed, 1),
+                    'pacing_sleep_ratio': round(window_sleep / elapsed, 3),
+                }
+                window_start += elapsed
+                window_frames = 0
+                window_sleep = 0.0
+                cpu_start = cpu_now
+                process_start = process_now
+    
+    def frame_encoded(self, capture_thread, sequence, timestamp, captured_at, future):
+        """Encoder thread callback; every submitted frame reports back exactly once"""
+        try:
+            frame_data = future.result()
+        except Exception as e:
+            log.error("encode_error", "Frame encode failed", rate=1, error=e)
+            frame_data = None
+        try:
+            self.loop.call_soon_threadsafe(
+                self.release_in_order, capture_thread, sequence, timestamp,
+                captured_at, frame_data)
+        except RuntimeError:
+            # Event loop closed underneath us; nothing left to deliver to
+            pass
+    
+    def release_in_order(self, capture_thread, sequence, timestamp, captured_at, frame_data):
+        """Runs on the event loop; publishes encoded frames strictly in capture order"""
+        if capture_thread is not self.capture_thread:
+            return  # left over from a previous start()
+        self.reorder[sequence] = (timestamp, captured_at, frame_data)
+        while self.next_sequence in self.reorder:
+            timestamp, captured_at, frame_data = self.reorder.pop(self.next_sequence)
+            self.next_sequence = (self.next_sequence + 1) & 0xFFFFFFFF
+            if frame_data is None:
+                self.counters['encode_failed'] += 1
+                continue
+            jpeg, settings, encoded_at, recording = frame_data
+            if recording:
+                # Recorded in capture order, however late; the recorder counts failed encodes
+                recorder, recorded = recording
+                if recorded is None:
+                    recorder.drop()
+                else:
+                    recorder.submit(recorded, timestamp, True)
+            if settings is None:
+                continue  # recorded only
+            if jpeg is None:
+                self.counters['encode_failed'] += 1
+                continue
+            self.counters['encoded'] += 1
+            if time.monotonic() - captured_at > self.latency_budget:
+                self.counters['late_dropped'] += 1
+            else:
+                self.publish_frame(jpeg, settings, encoded_at, timestamp)
+    
+    def publish_frame(self, frame_data, settings, encoded_at, timestamp):
+        """Runs on the event loop; encoded once, shared by every subscribed client"""
+        if not self.active:
+            return
+        level, quality, frame_size = settings
+        published_at = time.time()
+        self.latency['capture_to_encoded'].record(encoded_at - timestamp)
+        self.latency['encoded_to_published'].record(published_at - encoded_at)
+        now = time.monotonic()
+        self.publish_window_frames += 1
+        if now - self.publish_window_start >= 1.0:
+            self.publish_fps = round(
+                self.publish_window_frames / (now - self.publish_window_start), 1)
+            self.publish_window_start = now
+            self.publish_window_frames = 0
+        
+        self.sequence = (self.sequence + 1) & 0xFFFFFFFF
+        self.counters['published'] += 1
+        self.sample_allocations()
+        if self.recorder:
+            self.recorder.record(KIND_FRAME, CODEC_IDS['jpeg'], level, self.sequence,
+                                 published_at - timestamp, len(frame_data))
+        self.hub.publish({
+            'frame': frame_data,
+            'timestamp': timestamp,
+            'sequence': self.sequence,
+            'level': level,
+            'quality': quality,
+            'size': frame_size,
+            'fps': self.publish_fps,
+            'codec': 'jpeg',
+            'keyframe': True,
+            'encoded_at': encoded_at,
+            'published_at': published_at,
+            'messages': {},
+        })
+    
+    def subscribe(self, codec='jpeg', subscriber_class=None):
+        """Subscribe to a codec's frames, starting its streaming encoder if needed"""
+        # A new viewer gets a frame right away, not at the next keepalive
+        self.change_detector.reset()
+        if codec == 'jpeg':
+            return self.hub.subscribe(subscriber_class or FrameSubscriber)
+        if codec not in self.streams:
+            encoder = ENCODERS[codec](self.capture_size, self.target_fps,
+                                      partial(self.chunk_encoded, codec))
+            encoder.start()
+            self.streams[codec] = (encoder, FrameHub())
+            self.stream_encoders = tuple(encoder for encoder, _ in self.streams.values())
+        return self.streams[codec][1].subscribe(subscriber_class or ChunkSubscriber)
+    
+    def unsubscribe(self, subscriber):
+        self.hub.unsubscribe(subscriber)
+        for codec, (encoder, hub) in list(self.streams.items()):
+            if subscriber in hub.subscribers:
+                hub.unsubscribe(subscriber)
+                if not hub.subscribers:
+                    self.stop_stream(codec)
+        self.release_if_unwatched()
+    
+    async def start_recording(self, directory, codec='jpeg', **options):
+        """Save captured frames to disk as `codec` until stop_recording().
+
+        Frames are recorded before change detection, at the capture size and the
+        best quality level's JPEG quality and frame rate, whatever ABR does to
+        the live stream. JPEG is encoded on the encoder pool (reusing the live
+        encode at that level), other codecs get a streaming encoder of their
+        own; frames neither keeps up with are dropped and counted. The recording
+        counts as a viewer, so the camera stays on without clients.
+        """
+        if self.recording or not await self.start():
+            return None
+        recorder = VideoRecorder(directory, codec, **options)
+        encoder = None
+        if codec != 'jpeg':
+            encoder = ENCODERS[codec](self.capture_size, RECORDING_FPS, recorder.submit)
+        recorder.start()
+        try:
+            if encoder:
+                encoder.start()
+        except RuntimeError as e:
+            recorder.close()
+            log.error("recording_failed", "Can't start the recording encoder", error=e)
+            return None
+        self.recording = (recorder, encoder)
+        log.info("recording_started", "Recording video", directory=directory, codec=codec)
+        return recorder
+    
+    def stop_recording(self):
+        recorder, encoder = self.recording
+        self.recording = None
+        if encoder:
+            encoder.stop()
+        recorder.close()
+        log.info("recording_stopped", "Recording stopped", **recorder.get_stats())
+        self.release_if_unwatched()
+    
+    def stop_stream(self, codec):
+        encoder, hub = self.streams.pop(codec)
+        self.stream_encoders = tuple(encoder for encoder, _ in self.streams.values())
+        encoder.stop()
+        hub.close()
+    
+    def chunk_encoded(self, codec, payload, timestamp, keyframe):
+        """Streaming encoder thread callback"""
+        try:
+            self.loop.call_soon_threadsafe(
+                self.publish_chunk, codec, payload, timestamp, time.time(), keyframe)
+        except RuntimeError:
+            pass
+    
+    def publish_chunk(self, codec, payload, timestamp, encoded_at, keyframe):
+        if codec not in self.streams:
+            return
+        encoder, hub = self.streams[codec]
+        published_at = time.time()
+        self.latency['capture_to_encoded'].record(encoded_at - timestamp)
+        self.latency['encoded_to_published'].record(published_at - encoded_at)
+        self.counters['encoded'] += 1
+        self.counters['published'] += 1
+        self.sample_allocations()
+        if self.recorder:
+            self.recorder.record(KIND_FRAME, CODEC_IDS[codec], 0, encoder.counters['chunks'],
+                                 published_at - timestamp, len(payload))
+        hub.publish({
+            'frame': payload,
+            'timestamp': timestamp,
+            'sequence': encoder.counters['chunks'] & 0xFFFFFFFF,
+            'level': 0,
+            'quality': 0,
+            'size': encoder.frame_size,
+            'fps': self.publish_fps,
+            'codec': codec,
+            'keyframe': keyframe,
+            'encoded_at': encoded_at,
+            'published_at': published_at,
+            'messages': {},
+        })
+    
+    def frame_message(self, frame_data, video_format):
+        """Wire message for a frame, serialized once and shared by all clients"""
+        message = frame_data['messages'].get(video_format)
+        if message is None:
+            if video_format == 'binary':
+                message = pack_video_frame(frame_data)
+            elif video_format == 'mjpeg':
+                message = mjpeg_part(frame_data)
+            else:
+                message = frame_to_json(frame_data)
+            frame_data['messages'][video_format] = message
+            self.counters['serializations'] += 1
+        return message
+    
+    def count_gc(self, phase, info):
+        if phase == 'start':
+            self.gc_collections += 1
+    
+    def sample_allocations(self):
+        """Measure memory blocks gained per published frame, every ALLOCATION_WINDOW frames.
+
+        sys.getallocatedblocks() counts live blocks, so temporaries freed
+        within the window (thumbnails, frame dicts) cancel out. A steady
+        pipeline reads about 0, and anything that keeps memory per frame
+        (a leak, a cache that never stops growing) shows up.
+        """
+        published = self.counters['published']
+        sampled_at, blocks_then = self.allocation_sample
+        if published - sampled_at < ALLOCATION_WINDOW:
+            return
+        blocks = sys.getallocatedblocks()
+        self.blocks_per_frame = (blocks - blocks_then) / (published - sampled_at)
+        self.allocation_sample = (published, blocks)
+    
+    def get_allocation_stats(self):
+        return {
+            'pool_allocations': self.buffer_pool.allocations,
+            'serializations': self.counters['serializations'],
+            'allocated_blocks_per_frame': round(self.blocks_per_frame, 2),
+            'allocated_blocks': sys.getallocatedblocks(),
+            'gc_collections': self.gc_collections,
+            'gc_counts': gc.get_count(),
+        }
+    
+    def get_stats(self):
+        level, encode_params, frame_size = self.encode_settings
+        return dict(self.stats, **self.counters, **self.abr.get_stats(),
+                    **self.change_detector.get_stats(),
+                    active=self.active, standby=self.standby, idle_timeout=self.idle_timeout,
+                    publish_fps=self.publish_fps, quality_level=level,
+                    quality=encode_params[1], width=frame_size[0], height=frame_size[1],
+                    target_fps=self.target_fps, encoder_workers=self.encoder_workers,
+                    streams={codec: encoder.get_stats()
+                             for codec, (encoder, _) in self.streams.items()},
+                    latency_budget=self.latency_budget,
+                    subscribers=len(self.hub.subscribers),
+                    recording=dict(self.recording[0].get_stats(),
+                                   encoder=self.recording[1] and self.recording[1].get_stats())
+                              if self.recording else None)
 
 class AsyncRobotWebSocket(tornado.websocket.WebSocketHandler):
     clients = set()
     video_stream = VideoStream()
-    last_frame_time = time.time()
-    frame_count = 0
     video_tasks = {}  # Store video streaming tasks per client
+    next_client_id = 0
+    recorder = None  # see start_recorder()
     
     def check_origin(self, origin):
         return True
     
     def open(self):
-        print("\n[SERVER] Client connected")
+        log.info("client_connected", "Client connected", remote=self.request.remote_ip)
         AsyncRobotWebSocket.clients.add(self)
         self.video_active = False  # Track video state per client
-        self.write_message(json.dumps({
+        self.video_format = 'json'
+        self.video_codec = 'jpeg'
+        AsyncRobotWebSocket.next_client_id += 1
+        self.client_id = AsyncRobotWebSocket.next_client_id
+        self.video_metrics = ClientVideoMetrics()
+        self.control_format = 'json'
+        self.ack_mode = 'all'
+        self.control_sequence = 0
+        self.last_ack = None
+        self.outbound = OutboundScheduler(self)
+        self.send(json.dumps({
             'type': 'connection_status',
             'data': {'status': 'connected'}
         }))
-        print("[SERVER] Ready to receive commands")
     
-    async def handle_movement(self, command, power):
+    def send(self, message, priority='control', binary=False, callback=None, droppable=True):
+        """Queue a message on this connection's OutboundScheduler"""
+        self.outbound.send(message, priority, binary, callback, droppable)
+
+    def should_ack(self, status, command, power):
+        """Apply the negotiated ack mode against what the client was last told"""
+        return self.ack_mode != 'on_change' or (status, command, power) != self.last_ack
+
+    async def send_control_ack(self, command, power, status=ACK_ACCEPTED):
+        # Power is a u8 on the wire; JSON commands can carry 50.5 or 300
+        self.send(CONTROL_ACK.pack(
+            CONTROL_ACK_KIND, status,
+            command_code(command), max(0, min(100, int(round(power)))),
+            self.control_sequence), binary=True)
+        self.last_ack = (status, command, power)
+
+    async def reject_movement(self, command, error):
+        """Always answered, whatever the ack mode; the setpoint is left alone"""
+        log.warning("movement_rejected", "Movement command rejected", rate=2,
+                    client=self.client_id, error=error)
+        # The next valid command gets acked even in on_change mode
+        self.last_ack = None
+        if self.control_format == 'binary':
+            await self.send_control_ack(command, 0, ACK_REJECTED)
+            return
+        self.send(json.dumps({
+            'type': 'command_response',
+            'data': {'status': 'rejected', 'error': str(error), 'timestamp': time.time()}
+        }))
+
+    def record_command(self, command, power, lease_ms=None):
+        if self.recorder:
+            self.recorder.record(KIND_COMMAND, command_code(command), self.client_id & 0xFFFF,
+                                 self.control_sequence, power, lease_ms or 0)
+
+    async def handle_movement(self, command, power, lease_ms=None):
         """Handle movement commands separately from video"""
-        print(f"\n[SERVER] ⮕ Received movement command: {command} (Power: {power}%)")
+        self.record_command(command, power, lease_ms)
+        log.info("movement_command", "Movement command", rate=2, command=command, power=power)
+        if not self.should_ack(ACK_ACCEPTED, command, power):
+            return
+        if self.control_format == 'binary':
+            await self.send_control_ack(command, power)
+            return
         response = {
             'type': 'command_response',
             'data': {
@@ -129,97 +1310,398 @@ class AsyncRobotWebSocket(tornado.websocket.WebSocketHandler):
                 'timestamp': time.time()
             }
         }
-        await self.write_message(json.dumps(response))
-        print(f"[SERVER] ✓ Processed command: {command} (Power: {power}%)")
+        self.send(json.dumps(response))
+        self.last_ack = (ACK_ACCEPTED, command, power)
 
     async def handle_video(self):
         """Handle video streaming separately"""
         self.video_active = True
-        print("\n[SERVER] Starting video stream for client...")
+        log.info("video_requested", "Starting video stream for client",
+                 codec=self.video_codec, format=self.video_format, client=self.client_id)
         success = await AsyncRobotWebSocket.video_stream.start()
         
-        if success:
-            while self.video_active and AsyncRobotWebSocket.video_stream.active:
+        if not success:
+            return
+        
+        try:
+            subscriber = AsyncRobotWebSocket.video_stream.subscribe(self.video_codec)
+        except Exception as e:
+            log.error("encoder_failed", "Failed to start encoder", codec=self.video_codec, error=e)
+            self.video_active = False
+            AsyncRobotWebSocket.video_stream.release_if_unwatched()
+            self.send(json.dumps({
+                'type': 'video_error',
+                'data': {'codec': self.video_codec, 'error': str(e)}
+            }))
+            return
+        
+        video_stream = AsyncRobotWebSocket.video_stream
+        binary = self.video_format == 'binary'
+        # Streaming chunks can't be skipped individually; JPEG frames can
+        droppable = not ENCODERS[self.video_codec].streaming
+        skipped_at_start = video_stream.change_detector.counters['static_skipped']
+
+        def frame_sent(frame_data, size, buffered, sent, queued_at):
+            write_latency = time.monotonic() - queued_at
+            if sent:
+                self.video_metrics.frame_written(frame_data, size)
+            else:
+                subscriber.resync()
+            self.video_metrics.dropped = subscriber.dropped + self.outbound.dropped_video
+            self.video_metrics.static_skipped = (
+                video_stream.change_detector.counters['static_skipped'] - skipped_at_start)
+            # Scheduler callbacks keep firing after the session ends (outbound.close()
+            # drops what's queued); those must not leave a stale sample behind
+            if self.video_codec == 'jpeg' and self.video_active and not subscriber.closed:
+                video_stream.abr.report(self, write_latency, buffered / size)
+
+        try:
+            while self.video_active and video_stream.active:
                 try:
-                    frame_data = await AsyncRobotWebSocket.video_stream.frame_queue.get()
-                    
-                    # Calculate FPS
-                    current_time = time.time()
-                    AsyncRobotWebSocket.frame_count += 1
-                    elapsed = current_time - AsyncRobotWebSocket.last_frame_time
-                    
-                    if elapsed >= 1.0:
-                        fps = AsyncRobotWebSocket.frame_count / elapsed
-                        AsyncRobotWebSocket.frame_count = 0
-                        AsyncRobotWebSocket.last_frame_time = current_time
-                        frame_data['fps'] = round(fps, 1)
+                    frame_data = await subscriber.get()
+                    if frame_data is None:
+                        break
                     
                     if self.ws_connection is None:
                         break
-                        
-                    await self.write_message(json.dumps({
-                        'type': 'video_frame',
-                        'data': frame_data
-                    }))
+                    
+                    message = video_stream.frame_message(frame_data, self.video_format)
+                    # This connection's send backlog when the frame was queued, and
+                    # how long it took to go out, drive the shared quality level
+                    buffered = self.outbound.backlog_bytes
+                    self.send(message, 'video', binary,
+                              partial(frame_sent, frame_data, len(message), buffered),
+                              droppable)
                 except Exception as e:
-                    print(f"[SERVER] Video streaming error: {e}")
+                    log.error("video_send_error", "Video streaming error", client=self.client_id,
+                              error=e)
                     break
+        finally:
+            AsyncRobotWebSocket.video_stream.unsubscribe(subscriber)
+            AsyncRobotWebSocket.video_stream.abr.forget(self)
     
+    async def handle_lease_renew(self, lease_ms=None):
+        """Keepalive for a held movement; only meaningful with a control loop"""
+        pass
+
+    async def handle_control_packet(self, packet):
+        """Binary control path: a struct unpack instead of json.loads"""
+        op, command_id, power, lease_ms, sequence = CONTROL_PACKET.unpack(packet)
+        self.control_sequence = sequence
+        if op == CONTROL_OP_MOVE:
+            # An unknown id goes through as is, for handle_movement to reject
+            command = (MOVEMENT_COMMANDS[command_id] if command_id < len(MOVEMENT_COMMANDS)
+                       else command_id)
+            await self.handle_movement(command, power, lease_ms or None)
+        elif op == CONTROL_OP_RENEW:
+            await self.handle_lease_renew(lease_ms or None)
+
+    def record_message(self, message_type, size):
+        if self.recorder:
+            code = (RECORDED_MESSAGES.index(message_type)
+                    if message_type in RECORDED_MESSAGES else 0xFF)
+            self.recorder.record(KIND_MESSAGE, code, self.client_id & 0xFFFF, value=size)
+
     async def on_message(self, message):
         try:
+            if isinstance(message, bytes):
+                self.record_message('control_packet', len(message))
+                await self.handle_control_packet(message)
+                return
+
             data = json.loads(message)
             message_type = data.get('type')
+            self.record_message(message_type, len(message))
             
             if message_type == 'movement_command':
                 # Handle movement commands immediately
                 command = data['data']['command']
                 power = data['data'].get('power', 100)
-                await self.handle_movement(command, power)
+                # Optional lease: how long the command holds without a lease_renew
+                await self.handle_movement(command, power, data['data'].get('lease_ms'))
+            
+            elif message_type == 'lease_renew':
+                await self.handle_lease_renew(data.get('data', {}).get('lease_ms'))
+            
+            elif message_type == 'control_format':
+                # Opt into binary control packets and/or fewer acks
+                options = data.get('data', {})
+                control_format = options.get('format', 'json')
+                self.control_format = (control_format if control_format in CONTROL_FORMATS
+                                       else 'json')
+                ack_mode = options.get('acks', 'on_change')
+                self.ack_mode = ack_mode if ack_mode in ACK_MODES else 'on_change'
+                self.last_ack = None
+                self.send(json.dumps({
+                    'type': 'control_format',
+                    'data': {
+                        'format': self.control_format,
+                        'acks': self.ack_mode,
+                        'commands': MOVEMENT_COMMANDS,
+                    }
+                }))
             
             elif message_type == 'power_update':
                 power = data['data'].get('power', 100)
-                print(f"\n[SERVER] ⚡ Power level updated: {power}%")
+                log.info("power_update", "Power level updated", rate=2, power=power)
             
             elif message_type == 'start_video':
                 if not self.video_active:
+                    # Clients opt into raw binary frames; JSON stays the default
+                    options = data.get('data', {})
+                    video_format = options.get('format', 'json')
+                    self.video_format = video_format if video_format in VIDEO_FORMATS else 'json'
+                    # Encoder backend is per session; anything but JPEG is binary only
+                    video_codec = options.get('codec', 'jpeg')
+                    self.video_codec = video_codec if video_codec in ENCODERS else 'jpeg'
+                    if self.video_codec != 'jpeg':
+                        self.video_format = 'binary'
                     # Start video in a separate task
                     task = asyncio.create_task(self.handle_video())
                     self.video_tasks[id(self)] = task
             
+            elif message_type == 'frame_ack':
+                ack = data.get('data', {})
+                self.video_metrics.frame_acked(ack.get('sequence'), ack.get('displayed_at'))
+            
+            elif message_type == 'get_video_stats':
+                self.send(json.dumps({
+                    'type': 'video_stats',
+                    'data': dict(AsyncRobotWebSocket.video_stream.get_stats(),
+                                 outbound=self.outbound.get_stats())
+                }), 'telemetry')
+            
             elif message_type == 'stop_video':
                 self.video_active = False
                 if id(self) in self.video_tasks:
                     self.video_tasks[id(self)].cancel()
                     del self.video_tasks[id(self)]
-                print("\n[SERVER] Stopping video stream for client...")
+                log.info("video_stop_requested", "Stopping video stream for client",
+                         client=self.client_id)
+            
+            else:
+                await self.handle_extra_message(message_type, data)
                 
         except Exception as e:
-            print(f"[SERVER] Message handling error: {e}")
+            log.error("message_error", "Message handling error", rate=5, error=e)
+    
+    async def handle_extra_message(self, message_type, data):
+        """Hook for message types added by subclasses (see server_rasp.py)"""
+        pass
     
     def on_close(self):
-        print("\n[SERVER] Client disconnected")
+        log.info("client_disconnected", "Client disconnected", client=self.client_id)
         self.video_active = False
         if id(self) in self.video_tasks:
             self.video_tasks[id(self)].cancel()
             del self.video_tasks[id(self)]
+        self.outbound.close()
+        AsyncRobotWebSocket.video_stream.abr.forget(self)
         AsyncRobotWebSocket.clients.remove(self)
-        if len(AsyncRobotWebSocket.clients) == 0:
-            AsyncRobotWebSocket.video_stream.stop()
 
-def main():
-    app = tornado.web.Application([
-        (r"/ws", AsyncRobotWebSocket),
+
+class MjpegStreamHandler(tornado.web.RequestHandler):
+    """multipart/x-mixed-replace stream for VLC, OBS and plain <img> tags.
+
+    Viewers share the frames the websocket clients get (no re-encoding); each
+    has its own latest-frame slot and at most one frame in flight, so a stalled
+    viewer just drops frames instead of buffering or blocking the IOLoop.
+    """
+    viewers = set()
+
+    async def get(self):
+        video_stream = AsyncRobotWebSocket.video_stream
+        if not await video_stream.start():
+            raise tornado.web.HTTPError(503, reason="Camera unavailable")
+        
+        self.set_header('Content-Type', f'multipart/x-mixed-replace; boundary={MJPEG_BOUNDARY}')
+        self.set_header('Cache-Control', 'no-cache, no-store, must-revalidate')
+        self.set_header('Pragma', 'no-cache')
+        self.set_header('Connection', 'close')
+        
+        self.subscriber = video_stream.subscribe('jpeg')
+        MjpegStreamHandler.viewers.add(self)
+        log.info("mjpeg_connected", "MJPEG viewer connected", remote=self.request.remote_ip)
+        try:
+            while True:
+                frame_data = await self.subscriber.get()
+                if frame_data is None:
+                    break
+                self.write(video_stream.frame_message(frame_data, 'mjpeg'))
+                # Resolves once the kernel has taken the frame; until then newer
+                # frames simply replace each other in the subscriber slot
+                await self.flush()
+        except tornado.iostream.StreamClosedError:
+            pass
+        finally:
+            self.finish_viewer()
+
+    def on_connection_close(self):
+        self.finish_viewer()
+
+    def finish_viewer(self):
+        if self not in MjpegStreamHandler.viewers:
+            return
+        MjpegStreamHandler.viewers.discard(self)
+        # The stream goes on standby by itself once its last viewer unsubscribes
+        AsyncRobotWebSocket.video_stream.unsubscribe(self.subscriber)
+        log.info("mjpeg_disconnected", "MJPEG viewer disconnected")
+
+class DebugStatsHandler(tornado.web.RequestHandler):
+    """Video pipeline counters, including allocations per frame and GC activity"""
+    def get(self):
+        video_stream = AsyncRobotWebSocket.video_stream
+        recorder = AsyncRobotWebSocket.recorder
+        self.write(dict(video_stream.get_stats(), **video_stream.get_allocation_stats(),
+                        log=rov_log.get_stats(),
+                        recorder=recorder.get_stats() if recorder else None))
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """Per-stage video latency and per-client delivery metrics.
+
+    Prometheus text format by default; ?format=json for a JSON dump. Stages:
+    capture -> encoded -> published (stream-wide), then published -> written
+    and capture -> written/ack/display for each websocket client.
+    """
+    def get(self):
+        video_stream = AsyncRobotWebSocket.video_stream
+        clients = sorted(AsyncRobotWebSocket.clients, key=lambda client: client.client_id)
+        
+        if self.get_argument('format', None) == 'json':
+            self.write({
+                'stream': {stage: histogram.to_dict()
+                           for stage, histogram in video_stream.latency.items()},
+                'clients': {str(client.client_id): dict(client.video_metrics.to_dict(),
+                                                        codec=client.video_codec,
+                                                        format=client.video_format,
+                                                        outbound=client.outbound.get_stats())
+                            for client in clients},
+                'stats': video_stream.get_stats(),
+                'log': rov_log.get_stats(),
+            })
+            return
+        
+        # Metric name -> (type, samples); each family is written out in one block
+        families = {}
+        
+        def add(name, kind, samples):
+            families.setdefault(name, (kind, []))[1].extend(samples)
+        
+        for key, value in video_stream.get_stats().items():
+            if isinstance(value, (int, float)):
+                add(f'rov_video_{key}', 'gauge', [f'rov_video_{key} {float(value)}'])
+        for stage, histogram in video_stream.latency.items():
+            add('rov_video_stage_latency_seconds', 'histogram',
+                histogram.prometheus('rov_video_stage_latency_seconds', {'stage': stage}))
+        for client in clients:
+            metrics = client.video_metrics
+            labels = {'client': client.client_id}
+            for name, value in (('frames', metrics.frames), ('bytes', metrics.bytes),
+                                ('dropped', metrics.dropped), ('acks', metrics.acks),
+                                ('static_skipped', metrics.static_skipped)):
+                metric = f'rov_video_client_{name}_total'
+                add(metric, 'counter', [f'{metric}{{client="{client.client_id}"}} {value}'])
+            for stage, histogram in metrics.latency.items():
+                add('rov_video_client_latency_seconds', 'histogram',
+                    histogram.prometheus('rov_video_client_latency_seconds',
+                                         dict(labels, stage=stage)))
+            for name in OUTBOUND_CLASSES:
+                add('rov_outbound_queue_depth', 'gauge',
+                    [f'rov_outbound_queue_depth{{client="{client.client_id}",'
+                     f'class="{name}"}} {len(client.outbound.queues[name])}'])
+                add('rov_outbound_wait_seconds', 'histogram',
+                    client.outbound.wait[name].prometheus(
+                        'rov_outbound_wait_seconds', dict(labels, **{'class': name})))
+            add('rov_outbound_video_dropped_total', 'counter',
+                [f'rov_outbound_video_dropped_total{{client="{client.client_id}"}} '
+                 f'{client.outbound.dropped_video}'])
+        for key, value in rov_log.get_stats().items():
+            name = f'rov_log_{key}' + ('' if key == 'queued' else '_total')
+            add(name, 'gauge' if key == 'queued' else 'counter', [f'{name} {value}'])
+        lines = []
+        for name, (kind, samples) in families.items():
+            lines.append(f'# TYPE {name} {kind}')
+            lines += samples
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write('\n'.join(lines) + '\n')
+
+
+def make_app(websocket_handler=None, extra_handlers=()):
+    return tornado.web.Application([
+        (r"/ws", websocket_handler or AsyncRobotWebSocket),
+        (r"/video.mjpg", MjpegStreamHandler),
+        (r"/debug/stats", DebugStatsHandler),
+        (r"/metrics", MetricsHandler),
+        *extra_handlers,
     ])
+
+def start_recorder(directory, websocket_handler=None):
+    """Record incoming messages, commands and frame timing under `directory`"""
+    handler = websocket_handler or AsyncRobotWebSocket
+    recorder = FlightRecorder(directory)
+    recorder.start()
+    handler.recorder = recorder
+    handler.video_stream.recorder = recorder
+    log.info("recording", "Flight recorder on", directory=directory)
+    return recorder
+
+
+def add_video_arguments(parser):
+    """Camera, recording and video options, shared with server_rasp.py"""
+    parser.add_argument('--source', default='camera',
+                        help="camera[:N], synthetic[:gradient|noise|static] or a video file")
+    parser.add_argument('--record', metavar='DIR',
+                        help="write a flight recorder log (see flight_recorder.py) here")
+    parser.add_argument('--record-video', metavar='DIR',
+                        help="record full-quality video here (see video_recorder.py)")
+    parser.add_argument('--record-codec', choices=('jpeg', 'h264'), default='jpeg')
+    parser.add_argument('--change-threshold', type=float, default=10,
+                        help="gray levels a frame must change by to be sent while the "
+                             "scene is static (0 = send every frame)")
+    parser.add_argument('--idle-timeout', type=float, default=60,
+                        help="seconds the camera stays on standby after the last viewer "
+                             "leaves (0 = release it right away)")
+
+
+def configure_video(args, websocket_handler=None):
+    """Apply add_video_arguments() options; returns the FlightRecorder if --record is set.
+
+    Video recording starts once the IOLoop runs.
+    """
+    handler = websocket_handler or AsyncRobotWebSocket
+    video_stream = handler.video_stream
+    video_stream.source = args.source
+    video_stream.change_detector.threshold = args.change_threshold
+    video_stream.idle_timeout = args.idle_timeout
+    recorder = start_recorder(args.record, handler) if args.record else None
+    if args.record_video:
+        tornado.ioloop.IOLoop.current().add_callback(
+            video_stream.start_recording, args.record_video, args.record_codec)
+    return recorder
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ROV video/control websocket server")
+    parser.add_argument('--port', type=int, default=5000)
+    add_video_arguments(parser)
+    args = parser.parse_args()
     
-    print("\n[SERVER] Starting server on http://127.0.0.1:5000")
-    print("[SERVER] Waiting for client connection...")
-    app.listen(5000)
-    tornado.ioloop.IOLoop.current().start()
+    configure_video(args)
+    app = make_app()
+    
+    log.info("starting", f"Starting server on http://127.0.0.1:{args.port}", source=args.source)
+    app.listen(args.port)
+    io_loop = tornado.ioloop.IOLoop.current()
+    try:
+        io_loop.start()
+    finally:
+        if AsyncRobotWebSocket.video_stream.active:
+            AsyncRobotWebSocket.video_stream.stop()
 
 if __name__ == "__main__":
     try:
         main()
     except KeyboardInterrupt:
-        print("\n[SERVER] Shutting down...")
+        log.info("shutdown", "Shutting down")
     except Exception as e:
-        print(f"\n[SERVER] Error: {e}")
\ No newline at end of file
+        log.error("fatal", "Server error", error=e)
\ No newline at end of file
@@ -1,15 +1,29 @@
 import tornado.ioloop
 import tornado.web
 import tornado.websocket
+import argparse
 import json
 import time
 import asyncio
-import cv2
+import os
+import sys
 import numpy as np
-import base64
-import RPi.GPIO as GPIO
-from concurrent.futures import ThreadPoolExecutor
-from threading import Lock
+
+import server
+from server import LatencyHistogram, log
+
+# gpio_pins.py lives at the repo root, shared with main.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from gpio_pins import PinStateCache, load_gpio, load_pwm_backend
+from flight_recorder import KIND_SETPOINT
+from thrusters import ThrusterMixer, command_vector, load_topology
+
+# RPi.GPIO on the Pi; set ROV_GPIO=sim to run without hardware
+GPIO = load_gpio()
+
+# Only writes pin levels/duty cycles that actually change; software PWM
+# unless ROV_PWM=sysfs picks the hardware channels
+pins = PinStateCache(GPIO, load_pwm_backend(GPIO))
 
 
 class MotorController:
@@ -24,178 +38,337 @@ class MotorController:
         # GPIO setup for the motor
         GPIO.setwarnings(False)
         GPIO.setmode(GPIO.BCM)
-        GPIO.setup(self.input1, GPIO.OUT)
-        GPIO.setup(self.input2, GPIO.OUT)
-        GPIO.setup(self.pwm_pin, GPIO.OUT)
+        pins.setup_output(self.input1)
+        pins.setup_output(self.input2)
 
         # Set up PWM for the motor
-        self.pwm = GPIO.PWM(self.pwm_pin, 100)
-        self.pwm.start(0)
-
-    def forward(self, power=100):
-        GPIO.output(self.input1, GPIO.HIGH)
-        GPIO.output(self.input2, GPIO.LOW)
-        self.set_pwm(power)
-        self.current_state = "forward"
-
-    def backward(self, power=100):
-        GPIO.output(self.input1, GPIO.LOW)
-        GPIO.output(self.input2, GPIO.HIGH)
-        self.set_pwm(power)
-        self.current_state = "backward"
-
-    def stop(self):
-        GPIO.output(self.input1, GPIO.LOW)
-        GPIO.output(self.input2, GPIO.LOW)
-        self.set_pwm(0)
-        self.current_state = "off"
+        self.pwm = pins.setup_pwm(self.pwm_pin)
 
-    def set_pwm(self, value):
-        self.pwm_value = max(0, min(100, value))
-        self.pwm.ChangeDutyCycle(self.pwm_value)
+    # Pins are driven for all motors at once by RobotController.drive()
 
     def get_state(self):
         return {"name": self.name, "state": self.current_state, "power": self.pwm_value}
 
 
-class RobotController:
-    def __init__(self):
-        # Initialize motors
-        self.left_motor = MotorController("Left Motor", input1=17, input2=27, pwm_pin=4)
-        self.right_motor = MotorController(
-            "Right Motor", input1=5, input2=6, pwm_pin=13
-        )
+# Control loop tick lateness buckets (seconds)
+JITTER_BUCKETS = (0.0001, 0.0002, 0.0005, 0.001, 0.0015, 0.002, 0.003, 0.004, 0.005,
+                  0.0075, 0.01, 0.02, 0.05, 0.1)
 
-    def move_forward(self, power=100):
-        self.left_motor.forward(power)
-        self.right_motor.forward(power)
+# Motor state for each sign of a thruster output
+DIRECTION_STATES = ("backward", "off", "forward")
 
-    def move_backward(self, power=100):
-        self.left_motor.backward(power)
-        self.right_motor.backward(power)
 
-    def turn_left(self, power=100):
-        self.left_motor.backward(power)
-        self.right_motor.forward(power)
-
-    def turn_right(self, power=100):
-        self.left_motor.forward(power)
-        self.right_motor.backward(power)
+class RobotController:
+    """Every thruster in the topology, driven from one mixed axis command"""
+
+    def __init__(self, thrusters=None):
+        thrusters = thrusters or load_topology()
+        self.motors = {
+            thruster["name"]: MotorController(
+                thruster["label"], thruster["input1"], thruster["input2"], thruster["pwm_pin"]
+            )
+            for thruster in thrusters
+        }
+        self.mixer = ThrusterMixer(thrusters)
+        # Pin columns in mixer row order, for the vectorized update
+        motors = list(self.motors.values())
+        self.direction_pins = np.array(
+            [motor.input1 for motor in motors] + [motor.input2 for motor in motors]
+        )
+        self.pwm_pins = np.array([motor.pwm_pin for motor in motors])
+
+    def drive(self, outputs):
+        """Set all thrusters from mixer outputs in [-1, 1] as one pin update"""
+        signs = np.sign(outputs).astype(int)
+        duty_cycles = np.rint(np.abs(outputs) * 100).astype(int)
+        # input1 high for forward, input2 high for backward, both low when off
+        levels = np.concatenate([signs > 0, signs < 0]).astype(int)
+        pins.apply(
+            zip(self.direction_pins.tolist(), levels.tolist()),
+            zip(self.pwm_pins.tolist(), duty_cycles.tolist()),
+        )
+        for motor, sign, duty_cycle in zip(
+            self.motors.values(), signs.tolist(), duty_cycles.tolist()
+        ):
+            motor.current_state = DIRECTION_STATES[sign + 1]
+            motor.pwm_value = duty_cycle
 
     def stop(self):
-        self.left_motor.stop()
-        self.right_motor.stop()
+        self.drive(np.zeros(len(self.motors)))
+
+    def execute(self, command, power=100):
+        """Named command ("forward", "left", ...) or axis vector, at power %"""
+        self.drive(self.mixer.mix_command(command, power))
 
     def get_state(self):
-        return {
-            "left_motor": self.left_motor.get_state(),
-            "right_motor": self.right_motor.get_state(),
-        }
+        return {name: motor.get_state() for name, motor in self.motors.items()}
 
     def cleanup(self):
         self.stop()
-        GPIO.cleanup()
+        pins.cleanup()
+
+
+class ControlLoop:
+    """Fixed-rate actuation loop.
+
+    Movement messages only update the target setpoint; the loop applies it at
+    most once per tick, so a burst of repeated commands collapses into a single
+    set of GPIO writes. Tick jitter (how late each tick woke up) and overruns
+    (ticks that took longer than the period) are tracked for tuning the rate.
+
+    Setpoints are leased: unless renewed, a movement only holds for its lease
+    and the loop then stops the motors itself (deadman). The stop happens on
+    the first tick after expiry, so worst case lease + one tick.
+    """
+
+    def __init__(self, robot_controller, rate_hz=100, default_lease=0.5, max_lease=5.0):
+        self.robot_controller = robot_controller
+        self.rate_hz = rate_hz
+        self.default_lease = default_lease
+        self.max_lease = max_lease
+        self.target = ("stop", 0)
+        self.lease = None
+        self.lease_expires = None
+        self.lease_owner = None
+        # Pins start low with zero duty, i.e. already stopped
+        self.applied = ("stop", 0)
+        self.task = None
+        # Optional FlightRecorder; gets one record per applied setpoint
+        self.recorder = None
+        # Sub-millisecond buckets; the default ones are too coarse for a 10 ms tick
+        self.jitter = LatencyHistogram(JITTER_BUCKETS)
+        self.counters = {
+            "updates": 0,
+            "ticks": 0,
+            "actuations": 0,
+            "overruns": 0,
+            "skipped_ticks": 0,
+            "renewals": 0,
+            "lease_expiries": 0,
+        }
+        self.max_jitter = 0.0
+
+    def lease_duration(self, lease_ms):
+        """Requested lease in seconds, clamped; None means hold until told otherwise"""
+        if lease_ms is None:
+            return self.default_lease or None
+        if lease_ms <= 0:
+            return None
+        return min(lease_ms / 1000, self.max_lease)
+
+    def set_target(self, command, power, lease_ms=None, owner=None):
+        """Returns the granted lease in seconds (None for no expiry)"""
+        self.target = (command, power)
+        self.counters["updates"] += 1
+        self.lease = None if command == "stop" else self.lease_duration(lease_ms)
+        self.lease_expires = time.monotonic() + self.lease if self.lease else None
+        self.lease_owner = owner
+        return self.lease
+
+    def renew(self, owner, lease_ms=None):
+        """Extend the current lease; False if it already expired or isn't owner's"""
+        if self.lease_expires is None or owner is not self.lease_owner:
+            return False
+        if lease_ms is not None:
+            self.lease = self.lease_duration(lease_ms) or self.lease
+        self.lease_expires = time.monotonic() + self.lease
+        self.counters["renewals"] += 1
+        return True
 
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+            log.info("control_loop_started", "Control loop running", rate_hz=self.rate_hz)
 
-class VideoStream:
-    def __init__(self):
-        self.active = False
-        self.cap = None
-        self.frame_queue = asyncio.Queue(maxsize=1)
-        self.last_frame_time = 0
-        self.min_frame_interval = 1 / 60
-        self.executor = ThreadPoolExecutor(max_workers=1)
-        self.encode_params = [cv2.IMWRITE_JPEG_QUALITY, 65]
-        self.camera_lock = Lock()
-        self.initialization_error = None
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        period = 1 / self.rate_hz
+        next_tick = loop.time()
+        while True:
+            next_tick += period
+            await asyncio.sleep(max(0.0, next_tick - loop.time()))
+            tick_start = loop.time()
+            late = tick_start - next_tick
+            self.jitter.record(late)
+            self.max_jitter = max(self.max_jitter, late)
+            self.counters["ticks"] += 1
+
+            expired = self.lease_expires is not None and time.monotonic() >= self.lease_expires
+            if expired:
+                log.warning("lease_expired", "Lease expired, stopping motors",
+                            command=self.target[0])
+                self.target = ("stop", 0)
+                self.lease_expires = None
+                self.counters["lease_expiries"] += 1
+
+            if self.target != self.applied:
+                command, power = self.target
+                try:
+                    self.robot_controller.execute(command, power)
+                except Exception as e:
+                    log.error("actuation_error", "Control loop actuation error", rate=1, error=e)
+                self.applied = self.target
+                self.counters["actuations"] += 1
+                if self.recorder:
+                    self.recorder.record(
+                        KIND_SETPOINT, server.command_code(command), value=power, extra=expired
+                    )
+
+            if loop.time() - tick_start > period:
+                self.counters["overruns"] += 1
+            if late > period:
+                # Fell a whole tick behind; resync instead of bursting to catch up
+                self.counters["skipped_ticks"] += int(late / period)
+                next_tick = loop.time()
+
+    def get_stats(self):
+        return dict(
+            self.counters,
+            rate_hz=self.rate_hz,
+            coalesced=(self.counters["updates"] + self.counters["lease_expiries"]
+                       - self.counters["actuations"]),
+            jitter_mean_ms=self.jitter.to_dict()["mean_ms"],
+            # A bucket bound can overshoot what was actually seen
+            jitter_p99_ms=round(min(self.jitter.percentile(0.99), self.max_jitter) * 1000, 3),
+            jitter_max_ms=round(self.max_jitter * 1000, 3),
+            target={"command": self.target[0], "power": self.target[1]},
+            lease_remaining_ms=(
+                round(max(0.0, self.lease_expires - time.monotonic()) * 1000, 1)
+                if self.lease_expires is not None
+                else None
+            ),
+            gpio=pins.get_stats(),
+            log=server.rov_log.get_stats(),
+        )
 
-    # ... [Rest of VideoStream class implementation remains the same]
 
+class AsyncRobotWebSocket(server.AsyncRobotWebSocket):
+    """Video, telemetry and messaging come from server.py; this adds the motors"""
 
-class AsyncRobotWebSocket(tornado.websocket.WebSocketHandler):
-    clients = set()
-    video_stream = VideoStream()
     robot_controller = RobotController()
-    last_frame_time = time.time()
-    frame_count = 0
-    video_tasks = {}
-
-    def check_origin(self, origin):
-        return True
-
-    def open(self):
-        print("\n[SERVER] Client connected")
-        AsyncRobotWebSocket.clients.add(self)
-        self.video_active = False
-        self.write_message(
-            json.dumps({"type": "connection_status", "data": {"status": "connected"}})
-        )
-        print("[SERVER] Ready to receive commands")
-
-    async def handle_movement(self, command, power):
-        """Handle movement commands with actual motor control"""
-        print(f"\n[SERVER] ⮕ Executing movement command: {command} (Power: {power}%)")
-
-        # Execute the appropriate motor command
-        if command == "forward":
-            self.robot_controller.move_forward(power)
-        elif command == "backward":
-            self.robot_controller.move_backward(power)
-        elif command == "left":
-            self.robot_controller.turn_left(power)
-        elif command == "right":
-            self.robot_controller.turn_right(power)
-        elif command == "stop":
-            self.robot_controller.stop()
-
-        # Get current state after movement
-        state = self.robot_controller.get_state()
-
+    control_loop = ControlLoop(robot_controller)
+
+    async def handle_movement(self, command, power, lease_ms=None):
+        """Update the control loop's setpoint; the loop does the GPIO writes"""
+        self.record_command(command, power, lease_ms)
+        try:
+            # Checked here: the loop can't refuse a setpoint, only fail to apply it
+            self.robot_controller.mixer.validate(command, power)
+        except (TypeError, ValueError) as e:
+            await self.reject_movement(command, e)
+            return
+        if (command, power) != self.control_loop.target:
+            log.info(
+                "movement_setpoint", "Movement setpoint", rate=10, command=command, power=power
+            )
+        lease = self.control_loop.set_target(command, power, lease_ms, owner=self)
+
+        if not self.should_ack(server.ACK_ACCEPTED, command, power):
+            return
+        if self.control_format == "binary":
+            await self.send_control_ack(command, power)
+            return
         response = {
             "type": "command_response",
             "data": {
-                "status": "executed",
+                "status": "accepted",
                 "command": command,
                 "power": power,
-                "state": state,
+                "lease_ms": round(lease * 1000) if lease else None,
                 "timestamp": time.time(),
             },
         }
-        await self.write_message(json.dumps(response))
-        print(f"[SERVER] ✓ Executed command: {command} (Power: {power}%)")
-
-    # ... [Rest of AsyncRobotWebSocket class implementation remains the same]
+        self.send(json.dumps(response))
+        self.last_ack = (server.ACK_ACCEPTED, command, power)
+
+    async def handle_lease_renew(self, lease_ms=None):
+        if self.control_loop.renew(self, lease_ms):
+            return
+        # Only failed renewals are answered, so the client knows to resend
+        # the full movement command
+        command, power = self.control_loop.target
+        if not self.should_ack(server.ACK_LEASE_EXPIRED, command, power):
+            return
+        if self.control_format == "binary":
+            await self.send_control_ack(command, power, server.ACK_LEASE_EXPIRED)
+        else:
+            self.send(json.dumps({"type": "lease_expired"}))
+            self.last_ack = (server.ACK_LEASE_EXPIRED, command, power)
+
+    async def handle_extra_message(self, message_type, data):
+        if message_type == "movement_vector":
+            # Full 6-axis command for vehicles with more than two thrusters:
+            # {"surge": 0.5, "heave": -0.2, ...}, each clipped to [-1, 1]
+            options = data.get("data", {})
+            try:
+                if not isinstance(options, dict):
+                    raise ValueError("movement_vector data must be an object")
+                command = tuple(command_vector(options).tolist())
+            except (TypeError, ValueError) as e:
+                await self.reject_movement(None, e)
+                return
+            await self.handle_movement(
+                command, options.get("power", 100), options.get("lease_ms")
+            )
+        elif message_type == "get_control_stats":
+            self.send(
+                json.dumps({"type": "control_stats", "data": self.control_loop.get_stats()}),
+                "telemetry",
+            )
 
     def on_close(self):
-        print("\n[SERVER] Client disconnected")
-        self.video_active = False
-        if id(self) in self.video_tasks:
-            self.video_tasks[id(self)].cancel()
-            del self.video_tasks[id(self)]
-        AsyncRobotWebSocket.clients.remove(self)
-        if len(AsyncRobotWebSocket.clients) == 0:
-            AsyncRobotWebSocket.video_stream.stop()
-            AsyncRobotWebSocket.robot_controller.stop()  # Stop motors when last client disconnects
+        super().on_close()
+        if len(server.AsyncRobotWebSocket.clients) == 0:
+            # Stop motors when last client disconnects
+            AsyncRobotWebSocket.control_loop.set_target("stop", 0)
+            AsyncRobotWebSocket.robot_controller.stop()
+
+
+class ControlStatsHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.write(AsyncRobotWebSocket.control_loop.get_stats())
 
 
 def main():
+    parser = argparse.ArgumentParser(description="ROV motor/video websocket server")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--control-rate", type=float, default=100,
+                        help="control loop rate in Hz (50-200 is sensible)")
+    parser.add_argument("--default-lease-ms", type=float, default=500,
+                        help="lease for movement commands without one (0 = hold forever)")
+    server.add_video_arguments(parser)
+    args = parser.parse_args()
+
     try:
-        app = tornado.web.Application(
-            [
-                (r"/ws", AsyncRobotWebSocket),
-            ]
+        AsyncRobotWebSocket.control_loop.rate_hz = args.control_rate
+        AsyncRobotWebSocket.control_loop.default_lease = args.default_lease_ms / 1000
+        recorder = server.configure_video(args, AsyncRobotWebSocket)
+        if recorder:
+            AsyncRobotWebSocket.control_loop.recorder = recorder
+            pins.recorder = recorder
+        app = server.make_app(
+            AsyncRobotWebSocket, [(r"/debug/control", ControlStatsHandler)]
         )
 
-        print("\n[SERVER] Starting server on http://127.0.0.1:5000")
-        print("[SERVER] Initializing GPIO and motors...")
-        print("[SERVER] Waiting for client connection...")
-        app.listen(5000)
-        tornado.ioloop.IOLoop.current().start()
+        log.info("starting", f"Starting server on http://127.0.0.1:{args.port}",
+                 source=args.source, motors=len(AsyncRobotWebSocket.robot_controller.motors))
+        app.listen(args.port)
+        io_loop = tornado.ioloop.IOLoop.current()
+        io_loop.add_callback(AsyncRobotWebSocket.control_loop.start)
+        io_loop.start()
     except KeyboardInterrupt:
-        print("\n[SERVER] Shutting down...")
+        log.info("shutdown", "Shutting down")
+        # Closes the last video segment too
+        if AsyncRobotWebSocket.video_stream.active:
+            AsyncRobotWebSocket.video_stream.stop()
         AsyncRobotWebSocket.robot_controller.cleanup()
     except Exception as e:
-        print(f"\n[SERVER] Error: {e}")
+        log.error("fatal", "Server error", error=e)
         AsyncRobotWebSocket.robot_controller.cleanup()
 
 
@@ -0,0 +1,237 @@
+"""Onboard recording of the encoded video stream.
+
+VideoRecorder is fed captured frames encoded at full quality (see
+VideoStream.start_recording), so what's on disk doesn't depend on adaptive
+quality or on what live viewers are sent. Frames the encoders or the write
+queue can't keep up with are dropped, and counted in `dropped`, rather than
+stalling capture. It appends the encoded bytes to segment files from its own
+thread; the encoder side only does a queue put. JPEG goes to .mjpeg files
+(back-to-back JPEGs, which `ffplay -f mjpeg` and VLC play as is), H.264 to
+.h264 (Annex-B, every segment starting on a keyframe).
+
+Next to each segment is a .idx file of INDEX_ENTRY records (capture
+timestamp, byte offset, size, sequence, flags), written as frames go out, so
+RecordingSegment can seek to a point in time with a binary search instead of
+scanning the video:
+
+    python video_recorder.py recordings/
+    python video_recorder.py recordings/ --at 1792196300.5 --output frame.jpg
+"""
+import argparse
+import glob
+import os
+import queue
+import struct
+import threading
+import time
+
+import numpy as np
+
+# capture timestamp (f64), offset (u64), size (u32), sequence (u32), flags (u8), pad
+INDEX_ENTRY = struct.Struct('<dQIIB3x')
+INDEX_DTYPE = np.dtype([
+    ('timestamp', '<f8'), ('offset', '<u8'), ('size', '<u4'), ('sequence', '<u4'),
+    ('flags', 'u1'), ('pad', 'V3'),
+])
+INDEX_FLAG_KEYFRAME = 0x01
+
+EXTENSIONS = {'jpeg': 'mjpeg', 'h264': 'h264'}
+# How long after close() the writer waits for frames still in an encoder
+CLOSE_GRACE = 2.0
+
+
+class VideoRecorder:
+    """Bounded queue plus a writer thread; a full queue drops frames, never blocks"""
+    def __init__(self, directory, codec='jpeg', segment_seconds=300, segment_bytes=512 << 20,
+                 max_queue=120):
+        if codec not in EXTENSIONS:
+            raise ValueError(f"Can't record codec {codec!r}")
+        self.directory = directory
+        self.codec = codec
+        self.segment_seconds = segment_seconds
+        self.segment_bytes = segment_bytes
+        self.queue = queue.Queue(max_queue)
+        self.running = False
+        self.closed_at = None
+        self.finished = False
+        # Makes "finished" and a queue put atomic, so no late frame goes uncounted
+        self.lock = threading.Lock()
+        self.thread = None
+        self.sequence = 0
+        self.video = None
+        self.index = None
+        self.segment_path = None
+        self.segment_started = 0.0
+        self.segment_size = 0
+        # Inter-frame codecs can only (re)start on a keyframe
+        self.waiting_for_keyframe = codec != 'jpeg'
+        self.counters = {'frames': 0, 'bytes': 0, 'dropped': 0, 'segments': 0,
+                         'write_errors': 0}
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='video-recorder', daemon=True)
+        self.thread.start()
+
+    def submit(self, payload, timestamp, keyframe):
+        """Called from the encoder side for every encoded frame.
+
+        After close() only frames captured before it are taken, while the writer is still going.
+        """
+        with self.lock:
+            if self.finished or (self.closed_at is not None and timestamp > self.closed_at):
+                self.drop()
+                return
+            self.sequence = (self.sequence + 1) & 0xFFFFFFFF
+            try:
+                self.queue.put_nowait((payload, timestamp, self.sequence, keyframe))
+            except queue.Full:
+                self.counters['dropped'] += 1
+                if self.codec != 'jpeg':
+                    self.waiting_for_keyframe = True
+
+    def drop(self):
+        """Counts a captured frame that never made it to disk, e.g. no encoder was free"""
+        self.sequence = (self.sequence + 1) & 0xFFFFFFFF
+        self.counters['dropped'] += 1
+        if self.codec != 'jpeg':
+            self.waiting_for_keyframe = True
+
+    def open_segment(self, now):
+        self.close_segment()
+        self.counters['segments'] += 1
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(now))
+        base = os.path.join(self.directory, f"video-{stamp}-{self.counters['segments']:04d}")
+        self.segment_path = f'{base}.{EXTENSIONS[self.codec]}'
+        self.video = open(self.segment_path, 'wb')
+        self.index = open(f'{base}.idx', 'wb')
+        self.segment_started = now
+        self.segment_size = 0
+
+    def close_segment(self):
+        if self.video is not None:
+            self.video.close()
+            self.index.close()
+            self.video = self.index = None
+
+    def write(self, payload, timestamp, sequence, keyframe):
+        now = time.time()
+        rotate = (self.video is None or self.segment_size >= self.segment_bytes
+                  or now - self.segment_started >= self.segment_seconds)
+        # H.264 segments have to start on a keyframe to be playable on their own
+        if rotate and (keyframe or self.codec == 'jpeg' or self.video is None):
+            self.open_segment(now)
+        self.video.write(payload)
+        # Video first, so the index never points past the data
+        self.video.flush()
+        self.index.write(INDEX_ENTRY.pack(timestamp, self.segment_size, len(payload), sequence,
+                                          INDEX_FLAG_KEYFRAME if keyframe else 0))
+        self.index.flush()
+        self.segment_size += len(payload)
+        self.counters['frames'] += 1
+        self.counters['bytes'] += len(payload)
+
+    def run(self):
+        while True:
+            try:
+                item = self.queue.get(timeout=0.5)
+            except queue.Empty:
+                if self.running or time.time() - self.closed_at < CLOSE_GRACE:
+                    continue
+                break
+            keyframe = item[3]
+            if self.waiting_for_keyframe:
+                if not keyframe:
+                    self.counters['dropped'] += 1
+                    continue
+                self.waiting_for_keyframe = False
+            try:
+                self.write(*item)
+            except OSError:
+                self.counters['write_errors'] += 1
+        with self.lock:
+            self.finished = True
+        # Frames that raced in after the last get
+        while not self.queue.empty():
+            self.queue.get_nowait()
+            self.counters['dropped'] += 1
+        self.close_segment()
+
+    def close(self):
+        """Stop taking newly captured frames; the writer thread writes out what's queued.
+
+        Frames captured before now that an encoder hands over within CLOSE_GRACE still go to disk,
+        then the segment is closed. Never blocks.
+        """
+        if not self.running:
+            return
+        self.closed_at = time.time()
+        self.running = False
+
+    def get_stats(self):
+        return dict(self.counters, codec=self.codec, queued=self.queue.qsize(),
+                    segment=self.segment_path)
+
+
+class RecordingSegment:
+    """One recorded segment and its index, for seeking by capture time"""
+    def __init__(self, path):
+        self.path = path
+        index_path = os.path.splitext(path)[0] + '.idx'
+        # A half-written last entry (crash mid-write) is left out
+        count = os.path.getsize(index_path) // INDEX_DTYPE.itemsize
+        self.index = np.fromfile(index_path, INDEX_DTYPE, count)
+        self.keyframes = np.flatnonzero(self.index['flags'] & INDEX_FLAG_KEYFRAME)
+        self.file = open(path, 'rb')
+
+    def find(self, timestamp):
+        """Index of the last frame captured at or before `timestamp`"""
+        position = np.searchsorted(self.index['timestamp'], timestamp, side='right') - 1
+        return max(0, int(position))
+
+    def find_keyframe(self, timestamp):
+        """Where to start decoding to show `timestamp` (H.264 needs a keyframe)"""
+        position = self.find(timestamp)
+        before = self.keyframes[self.keyframes <= position]
+        return int(before[-1]) if len(before) else 0
+
+    def read(self, position):
+        entry = self.index[position]
+        self.file.seek(int(entry['offset']))
+        return self.file.read(int(entry['size']))
+
+    def close(self):
+        self.file.close()
+
+
+def recording_paths(directory):
+    return sorted(path for extension in EXTENSIONS.values()
+                  for path in glob.glob(os.path.join(directory, f'video-*.{extension}')))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="List recorded video segments or pull out a frame")
+    parser.add_argument('directory')
+    parser.add_argument('--at', type=float, help="unix capture time of the frame to extract")
+    parser.add_argument('--output', default='frame.jpg',
+                        help="where --at writes the frame (JPEG recordings only)")
+    args = parser.parse_args()
+
+    for path in recording_paths(args.directory):
+        segment = RecordingSegment(path)
+        timestamps = segment.index['timestamp']
+        if args.at is None:
+            duration = timestamps[-1] - timestamps[0] if len(timestamps) else 0.0
+            print(f"{path}: {len(timestamps)} frames, {duration:.1f} s, "
+                  f"{os.path.getsize(path) / 1e6:.1f} MB")
+        elif (len(timestamps) and path.endswith('.mjpeg')
+              and timestamps[0] <= args.at <= timestamps[-1]):
+            with open(args.output, 'wb') as f:
+                f.write(segment.read(segment.find(args.at)))
+            print(f"{args.output}: frame from {path}")
+        segment.close()
+
+
+if __name__ == '__main__':
+    main()
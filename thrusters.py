@@ -0,0 +1,120 @@
+"""Thruster topology and thrust mixing.
+
+The thrusters are described in a JSON file (thrusters.json next to this
+module, or $ROV_THRUSTERS; thrusters.sub6.json is a six-thruster vectored
+layout): the driver pins of each motor plus its "mix", how much it
+contributes to each axis. Six PWM pins are more than the Pi's two hardware
+PWM channels, so sub6 needs the software PWM backend (ROV_PWM=software, the
+default); ROV_PWM=sysfs refuses to start with it. Axes follow the usual
+marine convention: surge forward, sway right, heave up, yaw clockwise seen
+from above (turn right), pitch nose up, roll right side down.
+
+ThrusterMixer stacks the mixes into an N x 6 matrix, so any command vector
+becomes every thruster's output in one matrix product, however many
+thrusters the vehicle has.
+"""
+import json
+import os
+
+import numpy as np
+
+AXES = ("surge", "sway", "heave", "yaw", "pitch", "roll")
+
+# Named movement commands as unit axis commands
+COMMAND_AXES = {
+    "stop": {},
+    "forward": {"surge": 1},
+    "backward": {"surge": -1},
+    "left": {"yaw": -1},
+    "right": {"yaw": 1},
+    "up": {"heave": 1},
+    "down": {"heave": -1},
+}
+
+DEFAULT_TOPOLOGY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "thrusters.json")
+
+
+def load_topology(path=None):
+    """Thruster definitions from `path` or $ROV_THRUSTERS"""
+    path = path or os.environ.get("ROV_THRUSTERS", DEFAULT_TOPOLOGY)
+    with open(path) as f:
+        thrusters = json.load(f)["thrusters"]
+    names = [thruster["name"] for thruster in thrusters]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Duplicate thruster names in {path}")
+    for thruster in thrusters:
+        unknown = set(thruster.get("mix", {})) - set(AXES)
+        if unknown:
+            raise ValueError(f"Unknown axes for {thruster['name']}: {sorted(unknown)}")
+    return thrusters
+
+
+def axis_vector(axes):
+    """{'surge': 0.5, ...} (or a sequence in AXES order) as a command vector"""
+    if isinstance(axes, dict):
+        return np.array([axes.get(axis, 0.0) for axis in AXES], dtype=float)
+    vector = np.asarray(axes, dtype=float)
+    if vector.shape != (len(AXES),):
+        raise ValueError(f"Expected {len(AXES)} axis values, got {vector.shape}")
+    return vector
+
+
+def finite_axes(vector):
+    """NaN axes as 0 and infinite ones as full thrust"""
+    return np.nan_to_num(np.asarray(vector, dtype=float), nan=0.0, posinf=1.0, neginf=-1.0)
+
+
+def command_vector(axes):
+    """A client's axis command: every value finite, each clipped to [-1, 1]"""
+    vector = axis_vector(axes)
+    if not np.isfinite(vector).all():
+        raise ValueError("Axis values must be finite numbers")
+    return np.clip(vector, -1.0, 1.0)
+
+
+class ThrusterMixer:
+    def __init__(self, thrusters):
+        self.names = [thruster["name"] for thruster in thrusters]
+        self.matrix = np.array(
+            [axis_vector(thruster.get("mix", {})) for thruster in thrusters]
+        )
+        self.command_vectors = {
+            command: axis_vector(axes) for command, axes in COMMAND_AXES.items()
+        }
+        self.saturated = 0
+
+    def mix(self, command):
+        """Thruster outputs in [-1, 1] for an axis command vector.
+
+        If any thruster would need more than full thrust, all outputs are
+        scaled down together instead of clipping the saturated ones, so the
+        resulting force still points where the command asked. NaN axes count
+        as 0 and infinite ones as full thrust, so the outputs are always finite.
+        """
+        outputs = self.matrix @ finite_axes(command)
+        peak = np.abs(outputs).max(initial=0.0)
+        if peak > 1.0:
+            outputs /= peak
+            self.saturated += 1
+        return outputs
+
+    def validate(self, command, power):
+        """ValueError unless the command is a known name or finite axes and power is 0-100"""
+        if isinstance(command, str):
+            if command not in self.command_vectors:
+                raise ValueError(f"Unknown command {command!r}")
+        elif not isinstance(command, tuple) or not np.isfinite(axis_vector(command)).all():
+            raise ValueError("Command must be a name or finite axis values")
+        if (not isinstance(power, (int, float)) or isinstance(power, bool)
+                or not 0 <= power <= 100):
+            raise ValueError(f"Power must be a number from 0 to 100, got {power!r}")
+
+    def mix_command(self, command, power=100):
+        """Outputs for a named command or an axis vector, scaled by power (%)"""
+        # Power is a magnitude; a negative value must not reverse the command
+        power = float(np.clip(np.nan_to_num(power, nan=0.0), 0, 100))
+        if isinstance(command, str):
+            vector = self.command_vectors[command]
+        else:
+            vector = finite_axes(axis_vector(command))
+        return self.mix(vector * (power / 100))